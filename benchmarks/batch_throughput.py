@@ -0,0 +1,166 @@
+""" Training steps/sec of the MNIST example's input pipeline, before and after BatchIterator, on CPU.
+
+    python benchmarks/batch_throughput.py [--samples N] [--batch-size B] [--hidden H] [--epochs E]
+
+The step is the example's: its stax MLP, momentum and a jitted update, dispatched asynchronously, so the gather and
+the host to device copy of the next batch can overlap with it.
+
+before: the example's data_stream(), decoded float32 arrays in memory, a fancy-index gather per batch on the training
+        thread and a smaller last batch, which update is compiled again for (its mask is all ones); full train set
+        accuracy in one batch, one more compilation.
+after:  BatchIterator over the uint8 memmap with the lazy /255 transform and device_put=jax.device_put, with and
+        without background prefetch, fixed shape batches and a masked loss, accuracy in batches.
+
+The first compilation of update is done before timing, the ones a pipeline triggers on top of it are counted and timed.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+try:
+    from jax.example_libraries import optimizers, stax
+except ImportError:  # jax < 0.2.25, as the example
+    from jax.experimental import optimizers, stax
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from examples.datasets import LazyArray, _to_unit  # noqa: E402
+from mila_tools.batches import BatchIterator  # noqa: E402
+
+# examples/mnist_classifier.py, it deploys on import through examples/config.py
+LEARNING_RATE = 1e-4
+MOMENTUM_MASS = 0.99
+
+
+def make_model(hidden):
+    init_random_params, predict = stax.serial(
+        stax.Dense(hidden), stax.Relu,
+        stax.Dense(hidden), stax.Relu,
+        stax.Dense(10), stax.LogSoftmax)
+
+    def loss(params, batch, mask):
+        inputs, targets = batch
+        preds = predict(params, inputs)
+        return -jnp.sum(mask * jnp.sum(preds * targets, axis=1)) / jnp.maximum(jnp.sum(mask), 1)
+
+    @jax.jit
+    def num_correct(params, batch, mask):
+        inputs, targets = batch
+        return jnp.sum(mask * (jnp.argmax(predict(params, inputs), axis=1) == jnp.argmax(targets, axis=1)))
+
+    opt_init, opt_update, get_params = optimizers.momentum(LEARNING_RATE, mass=MOMENTUM_MASS)
+
+    @jax.jit
+    def update(i, opt_state, batch, mask):
+        params = get_params(opt_state)
+        return opt_update(i, jax.grad(loss)(params, batch, mask), opt_state)
+
+    _, init_params = init_random_params(jax.random.PRNGKey(0), (-1, 28 * 28))
+    return opt_init(init_params), update, num_correct, get_params
+
+
+def _compilations(jitted):
+    """ How many argument signatures jitted was compiled for, None when this jax does not tell. """
+    cache_size = getattr(jitted, "_cache_size", None)
+    return cache_size() if cache_size else None
+
+
+def make_data(folder, samples):
+    rng = np.random.RandomState(0)
+    images_path, labels_path = os.path.join(folder, "images.npy"), os.path.join(folder, "labels.npy")
+    np.save(images_path, rng.randint(0, 256, (samples, 28 * 28), dtype=np.uint8))
+    np.save(labels_path, np.eye(10, dtype=np.float32)[rng.randint(0, 10, samples)])
+    return np.load(images_path, mmap_mode="r"), np.load(labels_path, mmap_mode="r")
+
+
+def _warm_up(model, batch_size, device_put=lambda x: x):
+    """ Compiles update for full batches, both pipelines pay for that once. jit keys its cache on the argument types
+        too, the batches are numpy arrays or device arrays as the pipeline will pass them.
+    """
+    opt_state, update, _, _ = model
+    batch = tuple(device_put(np.zeros((batch_size, n), np.float32)) for n in (28 * 28, 10))
+    jax.block_until_ready(update(0, opt_state, batch, device_put(np.ones(batch_size, np.float32))))
+    return _compilations(update)
+
+
+def before(model, images, labels, batch_size, epochs):
+    opt_state, update, num_correct, get_params = model
+    compiled = _warm_up(model, batch_size)
+    train_images, train_labels = _to_unit(np.asarray(images)), np.asarray(labels)
+    num_train = len(train_images)
+    num_batches = -(-num_train // batch_size)
+
+    def data_stream():
+        rng = np.random.RandomState(0)
+        while True:
+            perm = rng.permutation(num_train)
+            for i in range(num_batches):
+                batch_idx = perm[i * batch_size:(i + 1) * batch_size]
+                yield train_images[batch_idx], train_labels[batch_idx]
+
+    batches = data_stream()
+    start = time.perf_counter()
+    for i in range(epochs * num_batches):
+        inputs, targets = next(batches)
+        opt_state = update(i, opt_state, (inputs, targets), np.ones(len(inputs), np.float32))
+    jax.block_until_ready(opt_state)
+    train_time = time.perf_counter() - start
+    recompiled = None if compiled is None else _compilations(update) - compiled
+
+    start = time.perf_counter()
+    num_correct(get_params(opt_state), (train_images, train_labels), np.ones(num_train, np.float32)).block_until_ready()
+    return epochs * num_batches / train_time, recompiled, time.perf_counter() - start
+
+
+def after(model, images, labels, batch_size, epochs, prefetch):
+    opt_state, update, num_correct, get_params = model
+    compiled = _warm_up(model, batch_size, jax.device_put)
+    arrays = (LazyArray(images, _to_unit), labels)
+    batches = BatchIterator(arrays, batch_size, epochs=epochs, prefetch=prefetch, device_put=jax.device_put)
+    start = time.perf_counter()
+    for i, (batch, mask) in enumerate(batches):
+        opt_state = update(i, opt_state, batch, mask)
+    jax.block_until_ready(opt_state)
+    train_time = time.perf_counter() - start
+    recompiled = None if compiled is None else _compilations(update) - compiled
+
+    start = time.perf_counter()
+    params = get_params(opt_state)
+    float(sum(num_correct(params, batch, mask) for batch, mask in
+              BatchIterator(arrays, batch_size, shuffle=False, epochs=1, prefetch=prefetch, device_put=jax.device_put)))
+    return epochs * batches.steps_per_epoch / train_time, recompiled, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=60000)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--epochs", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images, labels = make_data(tmp, args.samples)
+        runs = {
+            "before": lambda model: before(model, images, labels, args.batch_size, args.epochs),
+            "after, prefetch 0": lambda model: after(model, images, labels, args.batch_size, args.epochs, 0),
+            "after, prefetch 2": lambda model: after(model, images, labels, args.batch_size, args.epochs, 2),
+        }
+        print(f"jax {jax.__version__} on {jax.devices()[0].platform}, {args.samples} samples, "
+              f"batch size {args.batch_size}, remainder {args.samples % args.batch_size}")
+        print(f"{'pipeline':18s} {'steps/s':>8s} {'recompiles':>10s} {'accuracy s':>11s}")
+        for name, run in runs.items():
+            # a fresh jitted update per pipeline, so the compilations of one do not serve the next
+            steps_per_second, recompiled, accuracy_time = run(make_model(args.hidden))
+            recompiled = "?" if recompiled is None else recompiled
+            print(f"{name:18s} {steps_per_second:8.1f} {recompiled:>10} {accuracy_time:11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+""" End to end deploy latency against local stand-ins: a bare git repository as the remote, this machine as the cluster
+(host="localhost", no ssh) and mila_tools.fake_slurm as the scheduler.
+
+    python benchmarks/deploy_latency.py [--deploys N] [--chrome trace.json]
+
+Each deploy snapshots and pushes a toy project, uploads the job scripts, runs run_experiment.sh (clone, venv) and the
+job, whose entrypoint goes through deploy() like a real one and logs one scalar to a spool. The spans of the client and
+of the job are summed per deploy; the first deploy is cold (no git mirror, no scripts cache), the next ones warm. The venv is prepared beforehand, building it
+needs the network, so the venv span is the cache hit path. A last, warm, deploy goes through a sweep and
+localenv_sweep.sh, with a stand-in wandb CLI whose agent runs the entrypoint once.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOB_LIB = os.path.join(REPO_ROOT, "slurm_scripts", "job_lib.sh")
+sys.path.insert(0, REPO_ROOT)
+
+import git  # noqa: E402
+
+from mila_tools import fake_slurm, trace  # noqa: E402
+from mila_tools.mila_tools import _commit_and_sendjob, _environment_key  # noqa: E402
+from mila_tools.schedulers import LOCALHOST, SlurmScheduler, _LocalSession, wait_jobs  # noqa: E402
+
+ENTRYPOINT = """import mila_tools
+learning_rate = 0.1
+mila_tools.register(locals())
+logger = mila_tools.deploy(host="localhost", wandb_kwargs={"spool": True})
+logger.add_scalar("loss", 1.0, 0)
+"""
+# the wandb CLI, for the sweep deploy: `sweep` registers nothing, `agent` runs the entrypoint once
+WANDB_CLI = """#!/bin/sh
+case "$1" in
+  sweep) echo "wandb: View sweep at: https://wandb.ai/deploy_latency/sweeps/fake"
+         echo "wandb: Run sweep agent with: wandb agent deploy_latency/fake" ;;
+  agent) exec python main.py ;;
+esac
+"""
+SWEEP = """program: main.py
+method: grid
+parameters:
+  learning_rate:
+    values: [0.1]
+"""
+SPANS = ("ssh_connect", "upload_scripts", "git_snapshot", "git_push", "git_sync", "environment_key", "submit", "clone", "venv", "first_log")
+
+
+def _project(tmp):
+    remote = git.Repo.init(os.path.join(tmp, "remote.git"), bare=True)
+    work = git.Repo.init(os.path.join(tmp, "work"), initial_branch="main")
+    with work.config_writer() as config:  # HOME is swapped, the global identity is not there
+        config.set_value("user", "name", "deploy_latency")
+        config.set_value("user", "email", "deploy_latency@localhost")
+    with open(os.path.join(work.working_dir, "main.py"), "w") as fout:
+        fout.write(ENTRYPOINT)
+    with open(os.path.join(work.working_dir, "requirements.txt"), "w") as fout:
+        fout.write("")
+    work.index.add(["main.py", "requirements.txt"])
+    work.index.commit("toy project")
+    work.create_remote("origin", remote.working_dir)
+    work.git.push("origin", "main")
+    return work
+
+
+def _prepare_venv(work):
+    """ What activate_cached_venv would build, minus the downloads: the system packages and this checkout. """
+    # named after the python of the jobs, found on the PATH /etc/profile sets
+    command = f"source /etc/profile; source {JOB_LIB} && venv_key {_environment_key(work.working_dir)}"
+    venv_key = subprocess.check_output(["bash", "-c", command], text=True).strip()
+    venv = os.path.expanduser(f"~/.cache/mila_tools/venvs/{venv_key}")
+    subprocess.check_call([sys.executable, "-m", "venv", "--system-site-packages", "--without-pip", venv])
+    _install_wandb_cli(os.path.join(venv, "bin"))  # where pip would put it, the job finds it once the venv is active
+    open(os.path.join(venv, ".complete"), "w").close()
+
+
+def _install_wandb_cli(bin_path):
+    path = os.path.join(bin_path, "wandb")
+    with open(path, "w") as fout:
+        fout.write(WANDB_CLI)
+    os.chmod(path, 0o755)
+
+
+def deploy(work, index, scheduler, sweep_yaml=""):
+    """ run_experiment.sh, or localenv_sweep.sh with a sweep_yaml; raises if a job did not complete. """
+    sys.argv[0] = os.path.join(work.working_dir, "main.py")  # the entrypoint deploy() would see
+    jobs = _commit_and_sendjob(LOCALHOST, f"deploy_latency_{index}", sweep_yaml, work, "deploy_latency", 1, "")
+    states = wait_jobs(scheduler, [job.job_id for job in jobs], poll_interval=.05, timeout=300)
+    for job_id, state in states.items():
+        if state != "COMPLETED":
+            with open(os.path.join(os.environ["BUDDY_SLURM_BIN"], "state", f"{job_id}.out")) as fin:
+                raise RuntimeError(f"deploy {index}: job {job_id} ended {state}:\n{fin.read()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--deploys", type=int, default=3)
+    parser.add_argument("--chrome", default=None, help="also write all the spans as a Chrome trace")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        home = os.path.join(tmp, "home")
+        os.makedirs(os.path.join(home, "experiments"))
+        bin_path = fake_slurm.install(os.path.join(tmp, "bin"))
+        _install_wandb_cli(bin_path)
+        sweep_yaml = os.path.join(tmp, "sweep.yaml")
+        with open(sweep_yaml, "w") as fout:
+            fout.write(SWEEP)
+        os.environ.update(HOME=home, BUDDY_SLURM_BIN=bin_path, PATH=f"{bin_path}{os.pathsep}{os.environ['PATH']}",
+                          PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+        work = _project(tmp)
+        _prepare_venv(work)
+        scheduler = SlurmScheduler(_LocalSession())
+
+        events = []
+        print(f"{'deploy':8s}" + "".join(f"{span:>15s}" for span in SPANS) + f"{'wall s':>10s}")
+        for index in range(args.deploys + 1):
+            sweep = index == args.deploys  # the last one goes through localenv_sweep.sh
+            client_path = os.path.join(tmp, f"client-{index}.jsonl")
+            job_path = os.path.join(tmp, f"job-{index}.jsonl")
+            trace.tracer.path = client_path
+            os.environ[trace.TRACE_ENV] = job_path  # inherited by run_experiment.sh and the job
+            os.environ.pop(trace.JOB_START_ENV, None)
+
+            start = time.perf_counter()
+            deploy(work, index, scheduler, sweep_yaml if sweep else "")
+            wall = time.perf_counter() - start
+
+            deploy_events = trace.load(client_path) + (trace.load(job_path) if os.path.exists(job_path) else [])
+            events.extend(deploy_events)
+            totals = trace.summary(deploy_events)
+            print(f"{'sweep' if sweep else 'cold' if index == 0 else 'warm':8s}"
+                  + "".join(f"{totals[span][1]:15.3f}" if span in totals else f"{'-':>15s}" for span in SPANS)
+                  + f"{wall:10.3f}")
+
+        if args.chrome:
+            trace.to_chrome(events, args.chrome)
+            print(f"wrote {len(events)} spans to {args.chrome}")
+
+
+if __name__ == "__main__":
+    main()
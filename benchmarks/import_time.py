@@ -0,0 +1,146 @@
+""" Startup cost of mila_tools per code path, each measured in a fresh interpreter.
+
+    python benchmarks/import_time.py [--repeat N]
+
+Every path runs the real mila_tools code in a toy git project: deploy() inside a job, with and without the spool,
+deploy() of a local run, and deploy() to host="localhost" up to the scheduler, which is stubbed out so nothing gets
+started. The report lists the heavy modules each path ended up importing, so a dependency leaking into the wrong path
+shows up. wandb and tensorboardX are replaced by stand-ins when they are not installed, marked with a *.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("wandb", "git", "fabric", "paramiko", "tensorboardX", "matplotlib", "yaml", "torch", "numpy")
+
+_RUN = """
+mila_tools.register({"learning_rate": 0.1})
+logger = mila_tools.deploy(**DEPLOY_KWARGS)
+logger.add_scalar("loss", 1.0, 0)
+"""
+_SUBMIT = """
+import mila_tools.schedulers
+mila_tools.schedulers.SlurmScheduler.submit = lambda self, commands, **kwargs: []  # nothing is started
+mila_tools.register({"learning_rate": 0.1})
+try:
+    mila_tools.deploy(host="localhost")
+except SystemExit:
+    pass
+"""
+# name: (environment, DEPLOY_KWARGS, code after `import mila_tools`)
+PATHS = {
+    "import": ({}, {}, ""),
+    "remote-run": ({"SLURM_JOB_ID": "1"}, {}, _RUN),
+    "remote-spool": ({"SLURM_JOB_ID": "1"}, {"wandb_kwargs": {"spool": True}}, _RUN),
+    "local-run": ({}, {}, _RUN),
+    "submit": ({}, {}, _SUBMIT),
+}
+
+_PROBE = """
+import json, sys, time
+DEPLOY_KWARGS = {deploy_kwargs!r}
+start = time.perf_counter()
+import mila_tools
+{code}
+elapsed = time.perf_counter() - start
+print("@@import_time " + json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+# stand-ins for what the paths need but is not installed, just enough for WandbWrapper
+_STUBS = {
+    "wandb": """
+import types
+
+
+class Run:
+    name = id = "import_time"
+
+    def __init__(self):
+        self.config = types.SimpleNamespace(_items={}, update=lambda params, allow_val_change=False: None)
+
+    def log(self, row, step=None, commit=None):
+        pass
+
+
+def init(**kwargs):
+    return Run()
+""",
+    "tensorboardX": """
+class SummaryWriter:
+    def __init__(self, logdir=None):
+        pass
+
+    def add_scalar(self, tag, value, global_step=None):
+        pass
+""",
+}
+
+
+def _project(tmp):
+    """ A committed toy project with an origin, what deploy() expects to run in. """
+    project = os.path.join(tmp, "project")
+    os.makedirs(project)
+    for command in (["git", "init", "-q", "--bare", os.path.join(tmp, "remote.git")],
+                    ["git", "init", "-q", "-b", "main"],
+                    ["git", "config", "user.name", "import_time"],
+                    ["git", "config", "user.email", "import_time@localhost"],
+                    ["git", "remote", "add", "origin", os.path.join(tmp, "remote.git")]):
+        subprocess.check_call(command, cwd=project)
+    with open(os.path.join(project, "main.py"), "w") as fout:
+        fout.write("import mila_tools\n")
+    subprocess.check_call(["git", "add", "main.py"], cwd=project)
+    subprocess.check_call(["git", "commit", "-q", "-m", "toy project"], cwd=project)
+    return project
+
+
+def _stubs(tmp):
+    """ The stub folder to put on the path and the names of the modules stubbed. """
+    path = os.path.join(tmp, "stubs")
+    os.makedirs(path)
+    stubbed = [name for name in _STUBS if importlib.util.find_spec(name) is None]
+    for name in stubbed:
+        with open(os.path.join(path, f"{name}.py"), "w") as fout:
+            fout.write(_STUBS[name])
+    return path, stubbed
+
+
+def measure(tmp, project, stubs_path, path, repeat):
+    env_update, deploy_kwargs, code = PATHS[path]
+    env = {k: v for k, v in os.environ.items() if k not in ("SLURM_JOB_ID", "DISPLAY")}  # no dialog for the experiment id
+    env.update(env_update, HOME=os.path.join(tmp, "home"),
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH"), stubs_path])))
+    probe = _PROBE.format(deploy_kwargs=deploy_kwargs, code=code, heavy=HEAVY_MODULES)
+    samples = []
+    for _ in range(repeat):
+        retr = subprocess.run([sys.executable, "-c", probe], cwd=project, env=env, input="import_time\n",
+                              capture_output=True, text=True)
+        if retr.returncode != 0:
+            raise RuntimeError(f"the {path} path failed:\n{retr.stderr}")
+        report, = [row for row in retr.stdout.splitlines() if row.startswith("@@import_time ")]
+        samples.append(json.loads(report.split(" ", 1)[1]))
+    return statistics.median(s["seconds"] for s in samples), samples[-1]["loaded"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "home"))
+        project = _project(tmp)
+        stubs_path, stubbed = _stubs(tmp)
+        for path in PATHS:
+            seconds, loaded = measure(tmp, project, stubs_path, path, args.repeat)
+            loaded = [f"{m}*" if m in stubbed else m for m in loaded]
+            print(f"{path:12s} {seconds * 1000:8.1f} ms  loaded: {', '.join(loaded) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+""" Submission throughput and latency of the schedulers, on this machine: background processes and SLURM faked by
+mila_tools.fake_slurm, both through a _LocalSession so the numbers are about the schedulers and not the network.
+
+    python benchmarks/scheduler_throughput.py [--jobs N] [--batch-sizes 1,16]
+
+For each scheduler and batch size: submit N jobs that exit right away, poll until they all finished, then cancel N
+sleeping jobs. Over ssh every round trip adds the connection latency, which batching amortizes.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mila_tools import fake_slurm  # noqa: E402
+from mila_tools.schedulers import LocalScheduler, SlurmScheduler, _LocalSession, wait_jobs  # noqa: E402
+
+
+def _silence(fn, *args, **kwargs):
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def measure(scheduler, script, jobs, batch_size):
+    start = time.perf_counter()
+    submitted = _silence(scheduler.submit, [scheduler.batch_command(script, [0])] * jobs, batch_size=batch_size)
+    submit_seconds = time.perf_counter() - start
+    job_ids = [job.job_id for job in submitted]
+
+    start = time.perf_counter()
+    scheduler.status(job_ids)
+    status_seconds = time.perf_counter() - start
+    states = wait_jobs(scheduler, job_ids, poll_interval=.1, timeout=120)
+    drain_seconds = time.perf_counter() - start
+    failed = sum(state != "COMPLETED" for state in states.values())
+
+    sleeping = _silence(scheduler.submit, [scheduler.batch_command(script, [600])] * jobs, batch_size=batch_size)
+    start = time.perf_counter()
+    scheduler.cancel([job.job_id for job in sleeping])
+    states = wait_jobs(scheduler, [job.job_id for job in sleeping], poll_interval=.1, timeout=60)
+    cancel_seconds = time.perf_counter() - start
+    not_cancelled = sum(state != "CANCELLED" for state in states.values())
+    return submit_seconds, status_seconds, drain_seconds, cancel_seconds, failed + not_cancelled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=64)
+    parser.add_argument("--batch-sizes", default="1,16")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "job.sh")
+        with open(script, "w") as fout:
+            fout.write("sleep $1\n")
+        schedulers = {
+            "processes": LocalScheduler(),
+            "fake-slurm": SlurmScheduler(_LocalSession(), slurm_bin=fake_slurm.install(os.path.join(tmp, "bin"))),
+        }
+        print(f"{'scheduler':12s} {'batch':>5s} {'submit jobs/s':>14s} {'status ms':>10s} {'drain s':>8s} "
+              f"{'cancel s':>9s} {'errors':>6s}")
+        for name, scheduler in schedulers.items():
+            for batch_size in map(int, args.batch_sizes.split(",")):
+                submit, status, drain, cancel, errors = measure(scheduler, script, args.jobs, batch_size)
+                print(f"{name:12s} {batch_size:5d} {args.jobs / submit:14.1f} {status * 1000:10.1f} {drain:8.2f} "
+                      f"{cancel:9.2f} {errors:6d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+""" Throughput of the offline spool, writing from a run and replaying to a stub wandb that drops everything.
+
+    python benchmarks/spool_throughput.py [--events N] [--tags K]
+
+The stub keeps the measurement about the spool itself, a real sync is bound by the wandb service.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mila_tools.spool import _SpoolRun, sync  # noqa: E402
+
+
+class _StubRun:
+    def __init__(self):
+        self.config = types.SimpleNamespace(update=lambda params, allow_val_change=False: None)
+        self.rows = 0
+
+    def log(self, row, step=None, commit=None):
+        self.rows += 1
+
+    def save(self, path, base_path=None, policy="live"):
+        pass
+
+    def finish(self):
+        pass
+
+
+class _StubWandb:
+    def __init__(self):
+        self.runs = []
+
+    def init(self, **kwargs):
+        self.runs.append(_StubRun())
+        return self.runs[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--tags", type=int, default=10, help="scalars logged per step")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as spool_path:
+        run = _SpoolRun(spool_path, "benchmark", "spool_throughput")
+        run.config.update({"^lr": "0.1"})
+        start = time.perf_counter()
+        for event in range(args.events):
+            run.log({f"tag{event % args.tags}": float(event)}, step=event // args.tags, commit=False)
+        run.close()
+        write_seconds = time.perf_counter() - start
+
+        wandb = _StubWandb()
+        start = time.perf_counter()
+        sent = sum(sync(spool_path, wandb).values())
+        sync_seconds = time.perf_counter() - start
+
+    print(f"write {args.events / write_seconds:12.0f} events/s")
+    print(f"sync  {sent / sync_seconds:12.0f} events/s, {wandb.runs[0].rows} run.log calls")
+
+
+if __name__ == "__main__":
+    main()
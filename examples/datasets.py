@@ -14,7 +14,6 @@
 
 """Datasets used in examples."""
 
-import array
 import gzip
 import os
 import struct
@@ -24,6 +23,7 @@ from os import path
 import numpy as np
 
 _DATA = "/tmp/jax_example_data/"
+_CACHE = path.join(_DATA, "npy/")  # decoded once, shared by every process on the node
 
 
 def _download(url, filename):
@@ -46,45 +46,100 @@ def _one_hot(x, k, dtype=np.float32):
     return np.array(x[:, None] == np.arange(k), dtype)
 
 
+def _to_unit(x):
+    """Scale uint8 pixels to [0, 1] float32."""
+    return x.astype(np.float32) / np.float32(255.)
+
+
+class LazyArray:
+    """Indexes a (memory-mapped) array and applies fn to the result, only what is indexed gets materialized.
+
+    Integer, slice and index-array keys are supported on the first axis, an optional permutation is applied first.
+    """
+
+    def __init__(self, data, fn, permutation=None):
+        self.data = data
+        self.fn = fn
+        self.permutation = permutation
+        sample = fn(data[:1])
+        self.shape = (data.shape[0],) + sample.shape[1:]
+        self.dtype = sample.dtype
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, idx):
+        if self.permutation is not None:
+            idx = self.permutation[idx]
+        if isinstance(idx, (int, np.integer)):
+            return self.fn(self.data[idx][None])[0]  # fn works on batches
+        return self.fn(self.data[idx])
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype)
+
+
+def _decode_idx(gz_path, npy_path):
+    """Gunzip an IDX file once into a .npy file, atomically so concurrent processes can race on it."""
+    with gzip.open(gz_path, "rb") as fh:
+        content = fh.read()
+    ndim = content[3]
+    shape = struct.unpack(">" + "I" * ndim, content[4:4 + 4 * ndim])
+    data = np.frombuffer(content, dtype=np.uint8, offset=4 + 4 * ndim).reshape(shape)
+    tmp_path = "{}.{}.tmp.npy".format(npy_path[:-len(".npy")], os.getpid())
+    np.save(tmp_path, data)
+    os.replace(tmp_path, npy_path)
+
+
 def mnist_raw():
-    """Download and parse the raw MNIST dataset."""
+    """Download MNIST and decode it once into .npy files under _CACHE, return them memory-mapped as uint8 arrays.
+
+    The memory maps are read-only and backed by the page cache, processes on the same node share a single copy.
+    """
     # CVDF mirror of http://yann.lecun.com/exdb/mnist/
     base_url = "https://storage.googleapis.com/cvdf-datasets/mnist/"
 
-    def parse_labels(filename):
-        with gzip.open(filename, "rb") as fh:
-            _ = struct.unpack(">II", fh.read(8))
-            return np.array(array.array("B", fh.read()), dtype=np.uint8)
-
-    def parse_images(filename):
-        with gzip.open(filename, "rb") as fh:
-            _, num_data, rows, cols = struct.unpack(">IIII", fh.read(16))
-            return np.array(array.array("B", fh.read()),
-                            dtype=np.uint8).reshape(num_data, rows, cols)
-
+    arrays = []
     for filename in ["train-images-idx3-ubyte.gz", "train-labels-idx1-ubyte.gz",
                      "t10k-images-idx3-ubyte.gz", "t10k-labels-idx1-ubyte.gz"]:
-        _download(base_url + filename, filename)
-
-    train_images = parse_images(path.join(_DATA, "train-images-idx3-ubyte.gz"))
-    train_labels = parse_labels(path.join(_DATA, "train-labels-idx1-ubyte.gz"))
-    test_images = parse_images(path.join(_DATA, "t10k-images-idx3-ubyte.gz"))
-    test_labels = parse_labels(path.join(_DATA, "t10k-labels-idx1-ubyte.gz"))
-
+        npy_path = path.join(_CACHE, filename.replace(".gz", ".npy"))
+        if not path.isfile(npy_path):
+            _download(base_url + filename, filename)
+            os.makedirs(_CACHE, exist_ok=True)
+            _decode_idx(path.join(_DATA, filename), npy_path)
+        arrays.append(np.load(npy_path, mmap_mode="r"))
+
+    train_images, train_labels, test_images, test_labels = arrays
     return train_images, train_labels, test_images, test_labels
 
 
-def mnist(permute_train=False):
-    """Download, parse and process MNIST data to unit scale and one-hot labels."""
+def mnist(permute_train=False, lazy=False):
+    """Download, parse and process MNIST data to unit scale and one-hot labels.
+
+    With lazy=True the arrays are LazyArrays over the memory-mapped cache: scaling and one-hot encoding happen per batch
+    when they are indexed, nothing is copied up front.
+    """
     train_images, train_labels, test_images, test_labels = mnist_raw()
+    train_images = _partial_flatten(train_images)
+    test_images = _partial_flatten(test_images)
+
+    perm = None
+    if permute_train:
+        perm = np.random.RandomState(0).permutation(train_images.shape[0])
+
+    if lazy:
+        def one_hot(labels):
+            return _one_hot(labels, 10)
 
-    train_images = _partial_flatten(train_images) / np.float32(255.)
-    test_images = _partial_flatten(test_images) / np.float32(255.)
+        return (LazyArray(train_images, _to_unit, perm), LazyArray(train_labels, one_hot, perm),
+                LazyArray(test_images, _to_unit), LazyArray(test_labels, one_hot))
+
+    train_images = _to_unit(train_images)
+    test_images = _to_unit(test_images)
     train_labels = _one_hot(train_labels, 10)
     test_labels = _one_hot(test_labels, 10)
 
-    if permute_train:
-        perm = np.random.RandomState(0).permutation(train_images.shape[0])
+    if perm is not None:
         train_images = train_images[perm]
         train_labels = train_labels[perm]
 
@@ -22,28 +22,37 @@ optimization.
 import itertools
 import time
 
+import jax
 import jax.numpy as jnp
-import numpy.random as npr
 from jax import jit, grad, random
 from jax.experimental import optimizers
 from jax.experimental import stax
 from jax.experimental.stax import Dense, Relu, LogSoftmax
 
+from mila_tools import BatchIterator
+
 from . import config
 from . import datasets
 
 
-def loss(params, batch):
+def loss(params, batch, mask):
     inputs, targets = batch
     preds = predict(params, inputs)
-    return -jnp.mean(jnp.sum(preds * targets, axis=1))
+    return -jnp.sum(mask * jnp.sum(preds * targets, axis=1)) / jnp.maximum(jnp.sum(mask), 1)
 
 
-def accuracy(params, batch):
+@jit
+def num_correct(params, batch, mask):
     inputs, targets = batch
     target_class = jnp.argmax(targets, axis=1)
     predicted_class = jnp.argmax(predict(params, inputs), axis=1)
-    return jnp.mean(predicted_class == target_class)
+    return jnp.sum(mask * (predicted_class == target_class))
+
+
+def accuracy(params, arrays):
+    """Accuracy over fixed shape batches, the padded last one does not trigger a recompile."""
+    batches = BatchIterator(arrays, config.batch_size, shuffle=False, epochs=1, device_put=jax.device_put)
+    return sum(num_correct(params, batch, mask) for batch, mask in batches) / len(arrays[0])
 
 
 init_random_params, predict = stax.serial(
@@ -56,30 +65,19 @@ if __name__ == "__main__":
 
     num_epochs = 10
 
-    train_images, train_labels, test_images, test_labels = datasets.mnist()
-    num_train = train_images.shape[0]
-    num_complete_batches, leftover = divmod(num_train, config.batch_size)
-    num_batches = num_complete_batches + bool(leftover)
-
-
-    def data_stream():
-        rng = npr.RandomState(0)
-        while True:
-            perm = rng.permutation(num_train)
-            for i in range(num_batches):
-                batch_idx = perm[i * config.batch_size:(i + 1) * config.batch_size]
-                yield train_images[batch_idx], train_labels[batch_idx]
-
-
-    batches = data_stream()
+    train_images, train_labels, test_images, test_labels = datasets.mnist(lazy=True)
+    train_batches = BatchIterator((train_images, train_labels), config.batch_size, seed=0,
+                                  device_put=jax.device_put)
+    num_batches = train_batches.steps_per_epoch
+    batches = iter(train_batches)
 
     opt_init, opt_update, get_params = optimizers.momentum(config.learning_rate, mass=config.momentum_mass)
 
 
     @jit
-    def update(i, opt_state, batch):
+    def update(i, opt_state, batch, mask):
         params = get_params(opt_state)
-        return opt_update(i, grad(loss)(params, batch), opt_state)
+        return opt_update(i, grad(loss)(params, batch, mask), opt_state)
 
 
     _, init_params = init_random_params(rng, (-1, 28 * 28))
@@ -90,7 +88,7 @@ if __name__ == "__main__":
     for epoch in range(num_epochs):
         start_time = time.time()
         for _ in range(num_batches):
-            opt_state = update(next(itercount), opt_state, next(batches))
+            opt_state = update(next(itercount), opt_state, *next(batches))
         epoch_time = time.time() - start_time
 
         params = get_params(opt_state)
@@ -0,0 +1,119 @@
+""" Fixed shape minibatches for jitted training loops, gathered and sent to the device ahead of the step consuming them.
+
+    for (images, labels), mask in BatchIterator((train_images, train_labels), 128, device_put=jax.device_put):
+        params = update(params, images, labels, mask)  # weigh the per example losses with mask
+
+numpy is only imported when batches are drawn, like the rest of mila_tools it stays out of `import mila_tools`.
+"""
+import collections
+import math
+import queue
+import threading
+
+Batch = collections.namedtuple("Batch", "data mask")
+
+
+class BatchIterator:
+    """ Minibatches of a tuple of equally long arrays, numpy arrays, memmaps or anything indexable by an index array.
+
+        - Every epoch draws a permutation from seed + epoch (shuffle=False keeps the order), shard shard_index of
+          num_shards takes every num_shards-th index of it, so the shards of a data parallel job are disjoint and have the
+          same number of steps.
+        - Batches are gathered on a background thread, `prefetch` of them ahead of the training loop, and handed to
+          device_put (e.g. jax.device_put) there, so the copy to the device overlaps with the previous step.
+        - Batches always have batch_size rows: each shard is padded to steps_per_epoch * batch_size by repeating real
+          rows, mask is 1. for the real rows and 0. for the padding, a jitted step never sees a new shape. With several
+          shards the last batch of the shorter ones can be all padding, divide by max(mask.sum(), 1).
+
+        Iterating yields Batch(data, mask), data a tuple with one batch per array.
+    """
+
+    def __init__(self, arrays, batch_size, shuffle=True, seed=0, num_shards=1, shard_index=0, epochs=None, prefetch=2,
+                 device_put=None):
+        lengths = {len(array) for array in arrays}
+        if len(lengths) != 1:
+            raise ValueError(f"The arrays have different lengths: {sorted(lengths)}")
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"shard_index {shard_index} is not in [0, {num_shards})")
+        self.arrays = tuple(arrays)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.epochs = epochs
+        self.prefetch = prefetch
+        self.device_put = device_put
+        self.num_samples = lengths.pop()
+        self.shard_size = math.ceil(self.num_samples / num_shards)
+        self.steps_per_epoch = math.ceil(self.shard_size / batch_size)
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def _indices(self, epoch):
+        """ The shard's indices for the epoch, padded to steps_per_epoch * batch_size with real rows, and their mask. """
+        import numpy
+
+        if self.shuffle:
+            order = numpy.random.RandomState(self.seed + epoch).permutation(self.num_samples)
+        else:
+            order = numpy.arange(self.num_samples)
+        shard = order[self.shard_index::self.num_shards]
+        padded_size = self.steps_per_epoch * self.batch_size
+        mask = (numpy.arange(padded_size) < len(shard)).astype(numpy.float32)
+        return numpy.resize(shard, padded_size), mask  # resize repeats the real rows
+
+    def _batches(self):
+        """ The padded host batches, in order. """
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            indices, mask = self._indices(epoch)
+            for step in range(self.steps_per_epoch):
+                batch = slice(step * self.batch_size, (step + 1) * self.batch_size)
+                yield Batch(tuple(array[indices[batch]] for array in self.arrays), mask[batch])
+            epoch += 1
+
+    def _to_device(self, batch):
+        if self.device_put is None:
+            return batch
+        return Batch(tuple(self.device_put(x) for x in batch.data), self.device_put(batch.mask))
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for batch in self._batches():
+                yield self._to_device(batch)
+            return
+
+        buffer = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for batch in self._batches():
+                    batch = self._to_device(batch)
+                    while not stop.is_set():
+                        try:
+                            buffer.put(batch, timeout=.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                buffer.put(done)
+            except BaseException as e:  # re-raised on the training thread
+                buffer.put(e)
+
+        producer = threading.Thread(target=produce, name="mila_tools-batches", daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = buffer.get()
+                if batch is done:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()  # the consumer stopped early, or got an error
@@ -0,0 +1,107 @@
+import atexit
+import collections
+import concurrent.futures
+import copy
+import gzip
+import os
+import threading
+
+
+def _snapshot(obj, copy_all=True):
+    """ What gets saved for obj, the same with or without async_objects: modules, optimizers and anything else with a
+        state_dict() are reduced to it, tensors are moved to host memory, in containers too.
+        copy_all also copies what is left, so training can keep mutating the original while a background thread writes.
+    """
+    import torch
+
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=copy_all)
+    if callable(getattr(obj, "state_dict", None)) and not isinstance(obj, type):
+        return _snapshot(obj.state_dict(), copy_all)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, _snapshot(v, copy_all)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):  # the versions of a module state_dict, load_state_dict reads them
+            snapshot._metadata = copy.deepcopy(obj._metadata)
+        return snapshot
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+        return type(obj)(_snapshot(v, copy_all) for v in obj)
+    return copy.deepcopy(obj) if copy_all else obj
+
+
+class _ObjectStore:
+    """ Writes objects to <objects_path>/<tag>-<step>.pt[.gz] and hands them to run.save.
+        Modules and optimizers are saved as their state_dict on the host, see _snapshot: load them back with
+        module.load_state_dict(torch.load(path)).
+        With max_in_flight > 0 serialization happens on a background thread, save() returns a Future of the local path
+        and blocks only while max_in_flight checkpoints are already pending.
+        keep_last removes the older checkpoints of a tag from the local objects folder, wandb keeps all of them: they are
+        then saved with policy="now", copied for upload right away, since a "live" save uploads through a symlink to
+        the local file until the run ends. The newest checkpoint is only removed by the next save, even with keep_last=0,
+        so wandb has a whole save to copy it. With the spool, only the checkpoints still on disk at sync time get uploaded.
+    """
+
+    def __init__(self, run, objects_path, max_in_flight=0, keep_last=None, compress=False):
+        self.run = run
+        self.objects_path = objects_path
+        self.keep_last = keep_last
+        self.compress = compress
+        self._written = collections.defaultdict(collections.deque)  # tag -> local paths, oldest first
+        self._lock = threading.Lock()
+
+        self._executor = None
+        if max_in_flight > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mila_tools-objects")
+            self._slots = threading.BoundedSemaphore(max_in_flight)
+            self._pending = set()
+            atexit.register(self.wait)
+
+    def save(self, tag, obj, global_step):
+        if self._executor is None:
+            return self._write(tag, _snapshot(obj, copy_all=False), global_step)
+
+        snapshot = _snapshot(obj)
+        self._slots.acquire()
+        future = self._executor.submit(self._write, tag, snapshot, global_step)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def wait(self):
+        """ Blocks until every pending checkpoint is written, raising the first failure. """
+        if self._executor is None:
+            return
+        with self._lock:
+            pending = list(self._pending)
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+
+    def _write(self, tag, obj, global_step):
+        import cloudpickle
+        import torch
+
+        local_path = os.path.join(self.objects_path, f"{tag}-{global_step}.pt")
+        if self.compress:
+            local_path += ".gz"
+        with (gzip.open(local_path, "wb", compresslevel=3) if self.compress else open(local_path, "wb")) as fout:
+            torch.save(obj, fout, pickle_module=cloudpickle)
+
+        self.run.save(local_path, base_path=self.objects_path, policy="live" if self.keep_last is None else "now")
+        self._retain(tag, local_path)
+        return local_path
+
+    def _retain(self, tag, local_path):
+        if self.keep_last is None:
+            return
+        with self._lock:
+            written = self._written[tag]
+            written.append(local_path)
+            stale = [written.popleft() for _ in range(len(written) - max(self.keep_last, 1))]
+        for path in stale:
+            if os.path.exists(path):
+                os.remove(path)
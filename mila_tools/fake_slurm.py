@@ -0,0 +1,152 @@
+""" A stand-in for the SLURM commands mila_tools calls (sbatch, squeue, sacct, scancel), running the jobs as local
+processes, to benchmark and exercise deploys end to end on a single Linux box:
+
+    python -m mila_tools.fake_slurm install BIN_FOLDER
+    BUDDY_SLURM_BIN=BIN_FOLDER python main.py  # with deploy(host="localhost")
+
+Only the options mila_tools passes are understood: --array=A-B and --export=ALL,K=V, the rest are ignored. The state of
+the jobs lives in BIN_FOLDER/state/, job outputs in BIN_FOLDER/state/<job id>.out.
+"""
+import fcntl
+import json
+import os
+import signal
+import stat
+import subprocess
+import sys
+
+COMMANDS = ("sbatch", "squeue", "sacct", "scancel")
+_SHIM = """#!/bin/sh
+FAKE_SLURM_STATE={state} PYTHONPATH={package}${{PYTHONPATH:+:$PYTHONPATH}} exec {python} -m mila_tools.fake_slurm {command} "$@"
+"""
+
+
+def install(bin_path):
+    """ Writes the fake commands to bin_path, returns it. """
+    state_path = os.path.join(os.path.abspath(bin_path), "state")
+    os.makedirs(state_path, exist_ok=True)
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for command in COMMANDS:
+        path = os.path.join(bin_path, command)
+        with open(path, "w") as fout:
+            fout.write(_SHIM.format(state=state_path, package=package, python=sys.executable, command=command))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_path
+
+
+def _next_job_id(state_path):
+    with open(os.path.join(state_path, "next_id"), "a+") as fout:
+        fcntl.flock(fout, fcntl.LOCK_EX)
+        fout.seek(0)
+        job_id = int(fout.read() or 1)
+        fout.seek(0)
+        fout.truncate()
+        fout.write(str(job_id + 1))
+    return job_id
+
+
+def _alive(pid):
+    """ Zombies count as exited, nothing may reap the jobs sbatch left behind. """
+    try:
+        with open(f"/proc/{pid}/stat") as fin:
+            return fin.read().rpartition(")")[2].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def _state(state_path, job_id):
+    job_path = os.path.join(state_path, f"{job_id}.json")
+    if not os.path.exists(job_path):
+        return None
+    status_path = os.path.join(state_path, f"{job_id}.status")
+    if os.path.exists(os.path.join(state_path, f"{job_id}.cancelled")):
+        return "CANCELLED"
+    if os.path.exists(status_path):
+        with open(status_path) as fin:
+            code = fin.read().strip()
+        if code:
+            return "COMPLETED" if code == "0" else "FAILED"
+    with open(job_path) as fin:
+        return "RUNNING" if _alive(json.load(fin)["pid"]) else "FAILED"
+
+
+def _job_ids(state_path):
+    return sorted((f[:-len(".json")] for f in os.listdir(state_path) if f.endswith(".json")),
+                  key=lambda job_id: [int(part) for part in job_id.split("_")])
+
+
+def sbatch(state_path, argv):
+    array, env = None, dict(os.environ)
+    while argv and argv[0].startswith("-"):
+        option, _, value = argv.pop(0).partition("=")
+        if option == "--array":
+            first, _, last = value.partition("-")
+            array = range(int(first), int(last or first) + 1)
+        elif option == "--export":
+            env.update(kv.split("=", 1) for kv in value.split(",") if "=" in kv)
+    if not argv:
+        sys.exit("sbatch: error: missing the batch script")
+
+    job_id = _next_job_id(state_path)
+    tasks = [(f"{job_id}_{task}", task) for task in array] if array is not None else [(str(job_id), None)]
+    for task_id, task in tasks:
+        task_env = dict(env, SLURM_JOB_ID=task_id, SLURM_TMPDIR=os.path.join(state_path, "tmp", task_id))
+        if task is not None:
+            task_env.update(SLURM_ARRAY_JOB_ID=str(job_id), SLURM_ARRAY_TASK_ID=str(task))
+        os.makedirs(task_env["SLURM_TMPDIR"], exist_ok=True)
+        status_path = os.path.join(state_path, f"{task_id}.status")
+        with open(os.path.join(state_path, f"{task_id}.out"), "w") as out:
+            process = subprocess.Popen(["bash", "-c", f'bash "$@"; echo $? > {status_path}', "sbatch", *argv],
+                                       stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT, env=task_env,
+                                       start_new_session=True)
+        with open(os.path.join(state_path, f"{task_id}.json"), "w") as fout:
+            json.dump({"pid": process.pid, "argv": argv}, fout)
+    print(f"Submitted batch job {job_id}")
+
+
+def squeue(state_path, argv):
+    """ Running jobs as `%i %T`, whatever the format asked. """
+    for job_id in _job_ids(state_path):
+        if _state(state_path, job_id) == "RUNNING":
+            print(f"{job_id} RUNNING")
+
+
+def sacct(state_path, argv):
+    """ `JobID|State` of the jobs in -j, or of all of them. """
+    wanted = None
+    for option, value in zip(argv, argv[1:]):
+        if option == "-j":
+            wanted = set(value.split(","))
+    for job_id in _job_ids(state_path):
+        if wanted is None or job_id in wanted:
+            print(f"{job_id}|{_state(state_path, job_id)}")
+
+
+def scancel(state_path, argv):
+    for requested in argv:
+        for job_id in _job_ids(state_path):
+            if job_id != requested and not job_id.startswith(f"{requested}_"):
+                continue
+            if _state(state_path, job_id) != "RUNNING":
+                continue
+            open(os.path.join(state_path, f"{job_id}.cancelled"), "w").close()
+            with open(os.path.join(state_path, f"{job_id}.json")) as fin:
+                pid = json.load(fin)["pid"]
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("install",) + COMMANDS:
+        sys.exit(f"usage: python -m mila_tools.fake_slurm {{install BIN_FOLDER,{','.join(COMMANDS)}}} ...")
+    if sys.argv[1] == "install":
+        print(install(sys.argv[2]))
+        return
+    state_path = os.environ["FAKE_SLURM_STATE"]
+    globals()[sys.argv[1]](state_path, sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import concurrent.futures
+import os
+import threading
+
+
+class _FigureRenderer:
+    """ Renders figures on a worker pool, each one rasterized once, the pixels shared by wandb and tensorboard.
+        Tensorboard takes explicit steps, so the workers write to it directly with add_image; wandb media objects, built
+        by `image` from a PNG path or an array, are handed back through futures because wandb needs them logged in step
+        order, see WandbWrapper._log_figures.
+        At most max_pending figures are queued, submit blocks beyond that.
+    """
+
+    def __init__(self, figures_path, image, tensorboard=None, workers=2, max_pending=8):
+        self.figures_path = figures_path
+        self._image = image
+        self.tensorboard = tensorboard
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mila_tools-figures")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        os.makedirs(figures_path, exist_ok=True)
+
+    def _submit(self, fn, *args):
+        self._slots.acquire()
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def figure(self, tag, figure, global_step):
+        """ The worker renders a copy of the figure on a private Agg canvas, a GUI backend (TkAgg, ...) is not thread safe
+            and the user's figure keeps its canvas. The copy is taken here, the figure can be modified or closed as soon
+            as this returns.
+        """
+        import pickle
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        canvas = figure.canvas
+        FigureCanvasAgg(figure)  # without its pyplot manager, the copy does not register with pyplot when unpickled
+        try:
+            pickled = pickle.dumps(figure)
+        finally:
+            figure.set_canvas(canvas)
+        return self._submit(self._render_figure, tag, pickled, global_step)
+
+    def image(self, values):
+        return self._submit(self._image, values)
+
+    def _render_figure(self, tag, pickled, global_step):
+        import pickle
+
+        import matplotlib.image
+        import numpy
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        canvas = FigureCanvasAgg(pickle.loads(pickled))
+        canvas.draw()
+        rgba = numpy.asarray(canvas.buffer_rgba())
+
+        local_path = os.path.join(self.figures_path, f"{tag.replace('/', '_')}-{global_step}.png")
+        matplotlib.image.imsave(local_path, rgba, format="png")
+
+        if self.tensorboard:
+            self.tensorboard.add_image(tag, rgba, global_step, dataformats="HWC")
+
+        return self._image(local_path)  # wandb copies a path as is, no second encoding
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,316 @@
+""" Runs a wandb sweep YAML on the local machine, without a scheduler or the wandb sweep service.
+
+Trials are the entrypoint re-run with `--^param=value` overrides, the way register() parses them, at most one trial per
+GPU (or per core on machines without GPUs) at a time. Supported:
+    method: grid, random (bayes falls back to random)
+    parameters: value, values, distribution: constant, categorical, uniform, int_uniform, log_uniform, q_uniform
+    metric: {name, goal}, reported by the trials' WandbWrapper
+    early_terminate: {type: hyperband, min_iter, eta}, asynchronous successive halving on the metric reports
+    run_cap: number of trials of a random sweep, unbounded (until interrupted) otherwise
+
+Logs and results go to <ARTIFACTS_PATH>/sweeps/<experiment_id>/, the sweep can also be run without deploy():
+
+    python -m mila_tools.local_sweep sweep.yaml experiment_id [--workers N] -- python main.py
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+# set in the environment of the trials, see _TrialReporter
+TRIAL_NAME_ENV = "MILA_TOOLS_TRIAL_NAME"
+TRIAL_METRIC_ENV = "MILA_TOOLS_TRIAL_METRIC"
+TRIAL_METRIC_FILE_ENV = "MILA_TOOLS_TRIAL_METRIC_FILE"
+POLL_INTERVAL = 1.  # seconds
+
+
+def _sample_uniform(spec, rng):
+    return rng.uniform(spec["min"], spec["max"])
+
+
+def _sample_log_uniform(spec, rng):
+    return math.exp(rng.uniform(spec["min"], spec["max"]))  # as in wandb, min and max are natural logs
+
+
+def _sample_q_uniform(spec, rng):
+    return round(rng.uniform(spec["min"], spec["max"]) / spec.get("q", 1)) * spec.get("q", 1)
+
+
+SAMPLERS = {
+    "constant": lambda spec, rng: spec["value"],
+    "categorical": lambda spec, rng: rng.choice(spec["values"]),
+    "uniform": _sample_uniform,
+    "int_uniform": lambda spec, rng: rng.randint(spec["min"], spec["max"]),
+    "log_uniform": _sample_log_uniform,
+    "q_uniform": _sample_q_uniform,
+}
+
+
+def _distribution(spec):
+    if "value" in spec:
+        return "constant"
+    if "values" in spec:
+        return "categorical"
+    distribution = spec.get("distribution", "uniform")
+    if distribution not in SAMPLERS:
+        raise ValueError(f"Unsupported distribution {distribution}, local sweeps support {list(SAMPLERS)}")
+    return distribution
+
+
+def _grid_values(name, spec):
+    distribution = _distribution(spec)
+    if distribution == "constant":
+        return [spec["value"]]
+    if distribution == "categorical":
+        return list(spec["values"])
+    if distribution == "int_uniform":
+        return list(range(spec["min"], spec["max"] + 1))
+    if distribution == "q_uniform":
+        q = spec.get("q", 1)
+        return [k * q for k in range(math.ceil(spec["min"] / q), math.floor(spec["max"] / q) + 1)]
+    raise ValueError(f"A grid search needs discrete values, {name} has a {distribution} distribution")
+
+
+def trial_params(sweep, seed=None):
+    """ Yields the parameters of each trial, {name: value}. """
+    parameters = sweep["parameters"]
+    method = sweep.get("method", "random")
+    if method == "grid":
+        names = list(parameters)
+        for values in itertools.product(*(_grid_values(name, parameters[name]) for name in names)):
+            yield dict(zip(names, values))
+        return
+    if method != "random":
+        print(f"local sweeps do not support method: {method}, sampling at random")
+
+    rng = random.Random(seed)
+    samplers = {name: SAMPLERS[_distribution(spec)] for name, spec in parameters.items()}
+    for _ in (range(sweep["run_cap"]) if "run_cap" in sweep else itertools.count()):
+        yield {name: sampler(parameters[name], rng) for name, sampler in samplers.items()}
+
+
+def _override(name, value):
+    """ --^name=value, numbers as their repr so register() reads back the same value. """
+    if not name.startswith("^"):
+        name = "^" + name
+    return f"--{name}={value!r}" if isinstance(value, (int, float)) else f"--{name}={value}"
+
+
+def _devices():
+    """ One slot per visible GPU, [None] * cores without GPUs. """
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        gpus = [gpu for gpu in visible.split(",") if gpu.strip()]
+    elif shutil.which("nvidia-smi"):
+        listing = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True).stdout
+        gpus = [str(gpu) for gpu, row in enumerate(listing.splitlines()) if row.startswith("GPU")]
+    else:
+        gpus = []
+    return gpus or [None] * (os.cpu_count() or 1)
+
+
+class _TrialReporter:
+    """ Trial side: appends `step value` for each report of the sweep metric to the file the sweep is polling. """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    @classmethod
+    def from_environ(cls):
+        if TRIAL_METRIC_FILE_ENV not in os.environ:
+            return None
+        return cls(os.environ[TRIAL_METRIC_ENV], os.environ[TRIAL_METRIC_FILE_ENV])
+
+    def report(self, value, global_step):
+        with open(self.path, "a") as fout:
+            fout.write(f"{global_step} {float(value)!r}\n")
+
+
+class _Trial:
+    def __init__(self, index, name, params, log_path, metric_path):
+        self.index = index
+        self.name = name
+        self.params = params
+        self.log_path = log_path
+        self.metric_path = metric_path
+        self.process = None
+        self.slot = None
+        self.reports = []  # metric values, in report order
+        self.status = "pending"
+        self._offset = 0
+
+    def read_reports(self):
+        if not os.path.exists(self.metric_path):
+            return
+        with open(self.metric_path) as fin:
+            fin.seek(self._offset)
+            chunk = fin.read()
+        complete = chunk[:chunk.rfind("\n") + 1]  # a row being written is read on the next poll
+        self._offset += len(complete)
+        self.reports.extend(float(row.split()[1]) for row in complete.splitlines())
+
+    def best(self, maximize):
+        if not self.reports:
+            return None
+        return max(self.reports) if maximize else min(self.reports)
+
+    def summary(self, maximize):
+        return {"trial": self.name, "params": self.params, "status": self.status, "reports": len(self.reports),
+                "best": self.best(maximize), "returncode": self.process and self.process.returncode}
+
+
+class _SuccessiveHalving:
+    """ Asynchronous successive halving: when a trial reaches min_iter * eta^k metric reports, it goes on only if its
+        best value so far is in the top 1/eta of the trials that reached that rung before it.
+    """
+
+    def __init__(self, min_iter, eta, maximize):
+        self.min_iter = min_iter
+        self.eta = eta
+        self.maximize = maximize
+        self._rungs = {}  # rung -> recorded values
+        self._checked = {}  # trial name -> rungs already decided
+
+    def should_stop(self, trial):
+        checked = self._checked.setdefault(trial.name, set())
+        rung = self.min_iter
+        while rung <= len(trial.reports):
+            if rung not in checked:
+                checked.add(rung)
+                value = max(trial.reports[:rung]) if self.maximize else min(trial.reports[:rung])
+                recorded = self._rungs.setdefault(rung, [])
+                recorded.append(value)
+                if len(recorded) >= self.eta:
+                    cutoff = sorted(recorded, reverse=self.maximize)[max(len(recorded) // self.eta, 1) - 1]
+                    if (value < cutoff) if self.maximize else (value > cutoff):
+                        return True
+            rung *= self.eta
+        return False
+
+
+def run_sweep(sweep_yaml, command, experiment_id, sweeps_path, workers=None, seed=None):
+    """ Runs the trials of sweep_yaml as `command --^param=value...`, returns their summaries best first. """
+    import yaml
+
+    with open(sweep_yaml) as fin:
+        sweep = yaml.safe_load(fin)
+
+    metric = sweep.get("metric", {})
+    maximize = metric.get("goal", "minimize") == "maximize"
+    stopper = None
+    early_terminate = sweep.get("early_terminate")
+    if early_terminate:
+        if not metric:
+            raise ValueError("early_terminate needs a metric")
+        if early_terminate.get("type") != "hyperband":
+            raise ValueError(f"Unsupported early_terminate type {early_terminate.get('type')}, only hyperband is")
+        stopper = _SuccessiveHalving(early_terminate.get("min_iter", 3), early_terminate.get("eta", 3), maximize)
+
+    sweep_path = os.path.join(sweeps_path, experiment_id)
+    os.makedirs(sweep_path, exist_ok=True)
+    devices = _devices()
+    on_gpus = devices[0] is not None
+    slots = list(range(min(workers or len(devices), len(devices)) if on_gpus else workers or len(devices)))
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    print(f"local sweep {experiment_id}: {len(slots)} workers on {'GPUs' if on_gpus else 'CPUs'}, "
+          f"logs in {sweep_path}")
+
+    def launch(trial, slot):
+        env = dict(os.environ, **{TRIAL_NAME_ENV: trial.name})
+        if metric:
+            env.update({TRIAL_METRIC_ENV: metric["name"], TRIAL_METRIC_FILE_ENV: trial.metric_path})
+        preexec_fn = None
+        if on_gpus:
+            env["CUDA_VISIBLE_DEVICES"] = devices[slot]
+        else:
+            env["CUDA_VISIBLE_DEVICES"] = ""
+            if cpus and len(cpus) >= len(slots):  # each trial gets its own cores, as the agents in localenv_sweep.sh
+                per_trial = len(cpus) // len(slots)
+                cpu_slice = cpus[slot * per_trial:(slot + 1) * per_trial]
+                preexec_fn = lambda: os.sched_setaffinity(0, cpu_slice)  # noqa: E731
+                env["OMP_NUM_THREADS"] = env["MKL_NUM_THREADS"] = str(per_trial)
+        overrides = [_override(name, value) for name, value in trial.params.items()]
+        print(f"{trial.name}: {' '.join(overrides)}")
+        with open(trial.log_path, "w") as log:
+            trial.process = subprocess.Popen([*command, *overrides], stdout=log, stderr=subprocess.STDOUT, env=env,
+                                             preexec_fn=preexec_fn)
+        trial.slot = slot
+        trial.status = "running"
+
+    pending = (
+        _Trial(index, f"{experiment_id}_{index:03d}", params, os.path.join(sweep_path, f"trial-{index:03d}.log"),
+               os.path.join(sweep_path, f"trial-{index:03d}.metric"))
+        for index, params in enumerate(trial_params(sweep, seed))
+    )
+    running, done = [], []
+    free_slots = list(slots)
+    exhausted = False
+    try:
+        while not exhausted or running:
+            while free_slots and not exhausted:
+                trial = next(pending, None)
+                if trial is None:
+                    exhausted = True
+                else:
+                    launch(trial, free_slots.pop(0))
+                    running.append(trial)
+
+            time.sleep(POLL_INTERVAL)
+            for trial in list(running):
+                trial.read_reports()
+                if trial.process.poll() is None:
+                    if stopper and stopper.should_stop(trial):
+                        trial.process.terminate()
+                        trial.process.wait()
+                        trial.status = "stopped"
+                    else:
+                        continue
+                else:
+                    trial.read_reports()
+                    trial.status = "finished" if trial.process.returncode == 0 else "failed"
+                running.remove(trial)
+                free_slots.append(trial.slot)
+                done.append(trial)
+                print(f"{trial.name}: {trial.status}, {metric.get('name', 'metric')}={trial.best(maximize)}")
+                with open(os.path.join(sweep_path, "results.jsonl"), "a") as fout:
+                    fout.write(json.dumps(trial.summary(maximize)) + "\n")
+    except KeyboardInterrupt:
+        print(f"interrupted, stopping {len(running)} trials")
+        for trial in running:
+            trial.process.terminate()
+            trial.status = "interrupted"
+        for trial in running:
+            trial.process.wait()
+        done.extend(running)
+
+    summaries = [trial.summary(maximize) for trial in done]
+    ranked = sorted((s for s in summaries if s["best"] is not None), key=lambda s: s["best"], reverse=maximize)
+    if ranked:
+        print(f"best {metric['name']}={ranked[0]['best']}: {ranked[0]['trial']} {ranked[0]['params']}")
+    return ranked + [s for s in summaries if s["best"] is None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a sweep YAML on this machine")
+    parser.add_argument("sweep_yaml")
+    parser.add_argument("experiment_id")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--sweeps-path", default="runs/sweeps/")
+    argv = sys.argv[1:]
+    if "--" not in argv:
+        parser.error("missing the trial command, after --")
+    args = parser.parse_args(argv[:argv.index("--")])
+    command = argv[argv.index("--") + 1:]
+    run_sweep(args.sweep_yaml, command, args.experiment_id, args.sweeps_path, args.workers, args.seed)
+
+
+if __name__ == "__main__":
+    main()
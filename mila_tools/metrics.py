@@ -0,0 +1,377 @@
+import atexit
+import collections
+import concurrent.futures
+import queue
+import signal
+import sys
+import threading
+import time
+import weakref
+
+# a histogram or an image (or the future of one) and the call writing it to tensorboard, logged as is by the worker
+_Media = collections.namedtuple("_Media", "value write_tensorboard")
+
+
+def _resolve(value):
+    return value.result() if isinstance(value, concurrent.futures.Future) else value
+
+
+_pipelines = weakref.WeakSet()  # the open ones, flushed on SIGTERM
+_sigterm = {"installed": False, "previous": signal.SIG_DFL}
+
+
+def _on_sigterm(signum, frame):
+    previous = _sigterm["previous"]
+    if callable(previous):
+        previous(signum, frame)
+        # the handler returned, the job goes on: flush on other threads, this one may be inside a put holding the lock
+        for pipeline in list(_pipelines):
+            threading.Thread(target=pipeline.flush, name="mila_tools-sigterm", daemon=True).start()
+        return
+    sys.exit(128 + signum)  # unwinds the training loop, atexit then closes the pipelines
+
+
+def _install_sigterm_handler():
+    """ SLURM stops a job (time limit, preemption, scancel) with SIGTERM, which by default kills the process without
+        running atexit, what is queued is lost. It raises SystemExit instead. A handler set before runs first.
+    """
+    if _sigterm["installed"] or threading.current_thread() is not threading.main_thread():
+        return  # signal handlers can only be set from the main thread
+    previous = signal.getsignal(signal.SIGTERM)
+    if previous is None or previous == signal.SIG_IGN:
+        return  # set outside of python, or ignored on purpose
+    _sigterm.update(installed=True, previous=previous)
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
+
+class _ScalarPipeline:
+    """ Moves scalar logging off the training thread.
+        add_scalar only enqueues, a worker thread converts the values, groups them by step and issues one run.log per step.
+        Histograms and images go through the same queue, they reach wandb in step order with the scalars.
+        The queue is bounded: producers block when the worker falls behind.
+    """
+    _FLUSH = object()
+    _CLOSE = object()
+
+    def __init__(self, run, tensorboard=None, flush_interval=1., max_queue=10_000):
+        self.run = run
+        self.tensorboard = tensorboard
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._rows = {}  # step -> {tag: value}
+        self._error = None
+        self._closed = False
+        self._worker = threading.Thread(target=self._loop, name="mila_tools-scalars", daemon=True)
+        self._worker.start()
+        # wandb registers its own atexit hook in wandb.init, hooks run LIFO so this one drains first
+        atexit.register(self.close)
+        _pipelines.add(self)
+        _install_sigterm_handler()
+
+    def put(self, tag, value, global_step):
+        if self._error is not None:
+            raise RuntimeError("scalar logging worker failed") from self._error
+        self._queue.put((tag, value, global_step))
+
+    def put_media(self, tag, media, global_step, write_tensorboard=None):
+        """ media is a wandb object or a future of one, the worker waits for it. write_tensorboard() is called after. """
+        self.put(tag, _Media(media, write_tensorboard), global_step)
+
+    def flush(self):
+        """ Block until everything enqueued so far reached wandb and tensorboard. """
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done, None))
+        done.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put((self._CLOSE, None, None))
+        self._worker.join()
+
+    def _loop(self):
+        last_write = time.monotonic()
+        while True:
+            try:
+                tag, value, global_step = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                tag = None
+            else:
+                if tag is self._CLOSE:
+                    self._write()
+                    return
+                if tag is self._FLUSH:
+                    self._write()
+                    value.set()
+                    continue
+                self._rows.setdefault(global_step, {})[tag] = value
+
+            if tag is None or time.monotonic() - last_write >= self.flush_interval:
+                self._write()
+                last_write = time.monotonic()
+
+    def _write(self):
+        rows, self._rows = self._rows, {}
+        for global_step in sorted(rows):
+            try:
+                row = rows[global_step]
+                media = {tag: value for tag, value in row.items() if isinstance(value, _Media)}
+                # silently remove extra data such as torch gradients
+                scalars = {tag: float(value) for tag, value in row.items() if tag not in media}
+                media_values = {tag: _resolve(value.value) for tag, value in media.items()}
+                self.run.log({**scalars, **media_values}, step=global_step, commit=False)
+                if self.tensorboard:
+                    for tag, scalar_value in scalars.items():
+                        self.tensorboard.add_scalar(tag, scalar_value, global_step=global_step)
+                    for value in media.values():
+                        if value.write_tensorboard is not None:
+                            value.write_tensorboard()
+            except Exception as e:
+                # keep draining so producers never deadlock on a full queue, the error surfaces on the next put
+                self._error = e
+
+
+REDUCTIONS = ("mean", "min", "max", "last")
+
+
+def _array_module(value):
+    """ The array library (torch, jax.numpy or numpy) that can operate on value without leaving its device. """
+    root = type(value).__module__.split(".")[0]
+    if root == "torch":
+        return sys.modules["torch"]
+    if root in ("jax", "jaxlib"):
+        import jax.numpy
+        return jax.numpy
+    import numpy
+    return numpy
+
+
+def _to_host(values):
+    """ One device->host transfer per array library instead of one sync per value. """
+    hosted = list(values)
+    by_module = {}
+    for idx, value in enumerate(hosted):
+        by_module.setdefault(_array_module(value).__name__, []).append(idx)
+
+    for module_name, idxs in by_module.items():
+        if module_name == "torch":
+            torch = sys.modules["torch"]
+            device = hosted[idxs[0]].device
+            batch = torch.stack([hosted[i].detach().reshape(()).to(device, torch.float32) for i in idxs]).tolist()
+        elif module_name == "jax.numpy":
+            import jax
+            batch = jax.device_get([hosted[i] for i in idxs])
+        else:
+            batch = [hosted[i] for i in idxs]
+        for i, value in zip(idxs, batch):
+            hosted[i] = float(value)
+    return hosted
+
+
+def _to_numpy(value):
+    if hasattr(value, "detach"):
+        return value.detach().cpu().numpy()
+    import numpy
+    return numpy.asarray(value)
+
+
+def _arrays_to_host(arrays):
+    """ numpy copies of same shaped device arrays, one transfer per array library and device. jax arrays can also come
+        in tuples, device_get moves them in the same transfer.
+    """
+    hosted = list(arrays)
+    groups = {}
+    for idx, value in enumerate(hosted):
+        module_name = _array_module(value[0] if isinstance(value, tuple) else value).__name__
+        device = str(value.device) if module_name == "torch" else None  # torch.stack needs a single device
+        groups.setdefault((module_name, device), []).append(idx)
+
+    for (module_name, _), idxs in groups.items():
+        if module_name == "torch":
+            batch = sys.modules["torch"].stack([hosted[i].detach() for i in idxs]).cpu().numpy()
+        elif module_name == "jax.numpy":
+            import jax
+            batch = jax.device_get([hosted[i] for i in idxs])
+        else:
+            batch = [_to_numpy(hosted[i]) for i in idxs]
+        for i, value in zip(idxs, batch):
+            hosted[i] = value
+    return hosted
+
+
+HISTOGRAM_SAMPLING = (None, "reservoir", "strided", "streaming")
+
+
+def _torch_sample_indices(torch, num, sample_size, device):
+    """ sample_size distinct indices in [0, num), uniformly. randperm(num) is only affordable when num is close to
+        sample_size, otherwise random draws are deduplicated until there are enough and a random subset of them is kept.
+    """
+    if num <= 4 * sample_size:
+        return torch.randperm(num, device=device)[:sample_size]
+    idx = torch.randint(num, (0,), device=device)
+    while idx.numel() < sample_size:
+        idx = torch.cat([idx, torch.randint(num, (sample_size + sample_size // 4,), device=device)]).unique()
+    return idx[torch.randperm(idx.numel(), device=device)[:sample_size]]
+
+
+def _sample(xp, values, sampling, sample_size):
+    """ At most sample_size elements of the flat values: a uniform random subset, without replacement ("reservoir"), or
+        every k-th ("strided").
+    """
+    num = values.numel() if xp.__name__ == "torch" else values.size
+    if sampling not in ("reservoir", "strided") or num <= sample_size:
+        return values
+    if sampling == "strided":
+        return values[::-(-num // sample_size)]
+    if xp.__name__ == "torch":
+        return values[_torch_sample_indices(xp, num, sample_size, values.device)]
+    import numpy
+    # seeded from the global state, numpy.random.seed keeps the sample reproducible; choice without replacement does
+    # not allocate num indices when sample_size is small
+    rng = numpy.random.default_rng(numpy.random.randint(2 ** 31))
+    return values[rng.choice(num, size=sample_size, replace=False)]
+
+
+def _pack_histogram(xp, counts, edges, total, sum_squares):
+    """ counts, edges, sum and sum of squares in one small device array, the host gets them in a single transfer.
+        jax is float32 unless x64 is enabled, which rounds counts above 2 ** 24: the counts stay integers, in a tuple
+        with the rest that jax.device_get moves at once.
+    """
+    if xp.__name__ == "torch":
+        return xp.cat([counts.double(), edges.double(), xp.stack([total, sum_squares]).double()])
+    if xp.__name__ == "jax.numpy":
+        return counts, xp.concatenate([edges, xp.stack([total, sum_squares]).astype(edges.dtype)])
+    return xp.concatenate([counts.astype("float64"), edges.astype("float64"),
+                           xp.stack([total, sum_squares]).astype("float64")])
+
+
+def _device_histogram(values, bins, sampling=None, sample_size=2 ** 16, chunk_size=2 ** 22, value_range=None):
+    """ Bin values where they live, the result is (packed, num): a single small device array, see _pack_histogram, and
+        the number of values counted, known on the host.
+        The binning is done chunk by chunk against fixed edges, so besides the input only a chunk of bucket indices is
+        ever allocated. Without sampling every element is counted, between edges spanning the min and max of the values;
+        "streaming" takes the edges from value_range=(low, high) instead, a single pass over the values, the ones out of
+        range count in the first or last bin. "reservoir" and "strided" bound the work to sample_size elements for huge
+        tensors.
+    """
+    if sampling not in HISTOGRAM_SAMPLING:
+        raise ValueError(f"Unknown histogram sampling {sampling}, expected one of {HISTOGRAM_SAMPLING}")
+    if sampling == "streaming" and value_range is None:
+        raise ValueError('sampling="streaming" bins between fixed edges, it needs value_range=(low, high)')
+    xp = _array_module(values)
+    is_torch = xp.__name__ == "torch"
+    values = values.detach().flatten() if is_torch else xp.ravel(xp.asarray(values))
+    values = _sample(xp, values, sampling, sample_size)
+    num = values.numel() if is_torch else values.size
+
+    if sampling == "streaming":
+        low, high = value_range
+        span = max(high - low, 1e-12)
+    else:
+        low, high = values.min(), values.max()
+        span = (high - low).clip(min=1e-12)
+    counts = total = sum_squares = 0
+    for start in range(0, num, max(chunk_size, 1)):
+        chunk = values[start:start + chunk_size]
+        chunk = chunk.float() if is_torch else chunk.astype("float32")
+        scaled = (chunk - low) * (bins / span)
+        idx = (scaled.long() if is_torch else scaled.astype("int32")).clip(0, bins - 1)
+        if xp.__name__ == "jax.numpy":
+            counts = counts + xp.bincount(idx, length=bins)
+        else:
+            counts = counts + xp.bincount(idx, minlength=bins)
+        total = total + chunk.sum()
+        sum_squares = sum_squares + (chunk * chunk).sum()
+
+    if is_torch:
+        edges = xp.linspace(0., 1., bins + 1, device=values.device) * span + low
+    else:
+        edges = xp.linspace(0., 1., bins + 1) * span + low
+    return _pack_histogram(xp, counts, edges, total, sum_squares), num
+
+
+class HistogramStats(collections.namedtuple("HistogramStats", "counts edges num sum sum_squares")):
+    """ Host side binned histogram, enough for both wandb.Histogram and tensorboard's add_histogram_raw. """
+
+    @classmethod
+    def from_host(cls, packed, num):
+        if isinstance(packed, tuple):  # jax, see _pack_histogram
+            counts, packed = packed
+        else:
+            counts, packed = packed[:(len(packed) - 3) // 2], packed[(len(packed) - 3) // 2:]
+        return cls(counts.round().astype("int64"), packed[:-2], int(num), float(packed[-2]), float(packed[-1]))
+
+    @classmethod
+    def from_device(cls, packed, num):
+        return cls.from_host(*_arrays_to_host([packed]), num)
+
+
+class _DeviceAccumulator:
+    """ Keeps device arrays where they are, reducing them per tag until drain() moves everything to host at once. """
+
+    def __init__(self, reductions=None, histogram_bins=64, histogram_sampling=None, histogram_sample_size=2 ** 16,
+                 histogram_range=None):
+        reductions = reductions or {}
+        for tag, reduction in reductions.items():
+            if reduction not in REDUCTIONS:
+                raise ValueError(f"Unknown reduction {reduction} for {tag}, expected one of {REDUCTIONS}")
+        self.reductions = reductions
+        self.histogram_bins = histogram_bins
+        self.histogram_sampling = histogram_sampling
+        self.histogram_sample_size = histogram_sample_size
+        self.histogram_range = histogram_range
+        self._scalars = {}  # tag -> [accumulator, count, global_step]
+        self._histograms = {}  # tag -> (device stats, global_step)
+
+    def add_scalar(self, tag, scalar_value, global_step):
+        if hasattr(scalar_value, "detach"):
+            scalar_value = scalar_value.detach()
+
+        if tag not in self._scalars:
+            self._scalars[tag] = [scalar_value, 1, global_step]
+            return
+
+        entry = self._scalars[tag]
+        reduction = self.reductions.get(tag, "mean")
+        if reduction == "mean":
+            entry[0] = entry[0] + scalar_value
+        elif reduction == "last":
+            entry[0] = scalar_value
+        else:
+            xp = _array_module(entry[0])
+            entry[0] = (xp.minimum if reduction == "min" else xp.maximum)(entry[0], scalar_value)
+        entry[1] += 1
+        entry[2] = global_step
+
+    def add_histogram(self, tag, values, global_step, sampling=None, sample_size=None, value_range=None):
+        # only the latest histogram per tag survives until the next drain, as with a "last" reduction
+        stats = _device_histogram(values, self.histogram_bins, sampling or self.histogram_sampling,
+                                  sample_size or self.histogram_sample_size,
+                                  value_range=value_range or self.histogram_range)
+        self._histograms[tag] = (stats, global_step)
+
+    def drain(self):
+        """ Returns {global_step: {tag: float or HistogramStats}} and resets the accumulators. """
+        scalars, self._scalars = self._scalars, {}
+        histograms, self._histograms = self._histograms, {}
+
+        tags = list(scalars.keys())
+        reduced = []
+        for tag in tags:
+            accumulator, count, _ = scalars[tag]
+            if self.reductions.get(tag, "mean") == "mean":
+                accumulator = accumulator / count
+            reduced.append(accumulator)
+
+        rows = {}
+        for tag, value in zip(tags, _to_host(reduced)):
+            rows.setdefault(scalars[tag][2], {})[tag] = value
+        hist_tags = list(histograms.keys())
+        for tag, packed in zip(hist_tags, _arrays_to_host(histograms[tag][0][0] for tag in hist_tags)):
+            (_, num), global_step = histograms[tag]
+            rows.setdefault(global_step, {})[tag] = HistogramStats.from_host(packed, num)
+        return rows
@@ -1,27 +1,29 @@
-import ast
+import atexit
 import concurrent.futures
 import datetime
+import functools
+import hashlib
+import importlib.util
 import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 import types
 
-import fabric
-import git
-import matplotlib.pyplot as plt
-import tensorboardX
-import wandb
-import wandb.cli
-import yaml
-from paramiko.ssh_exception import SSHException
-
-try:
-    import torch
-except ImportError:
-    TORCH_ENABLED = False
-else:
-    TORCH_ENABLED = True
+from .batches import Batch, BatchIterator
+from .checkpoints import _ObjectStore
+from .figures import _FigureRenderer
+from .metrics import HistogramStats, _DeviceAccumulator, _ScalarPipeline, _device_histogram
+from .pipeline import _Pipeline
+from .run_index import diff_runs, find_runs, list_runs, load_run_params, record_run
+from .schema import _Schema
+
+# Heavy dependencies (wandb, git, fabric, tensorboardX, matplotlib, yaml, torch) are imported by the code path using them,
+# a job only pays for what it runs: the submit path never loads wandb, the remote path never loads fabric.
+TORCH_ENABLED = importlib.util.find_spec("torch") is not None
 
 wandb_escape = "^"
 hyperparams = None
@@ -31,8 +33,10 @@ ARTIFACTS_PATH = "runs/"
 
 
 def register(config_params):
+    """ Applies the --name=value arguments to config_params, typed after the defaults, and returns the parameters as a
+        frozen Config. config_params is updated in place, register(locals()) at module level sets the script globals.
+    """
     global hyperparams
-    # TODO: fails on nested config object
     if hyperparams is not None:
         raise RuntimeError("refusing to overwrite registered parameters")
 
@@ -40,26 +44,27 @@ def register(config_params):
         if k.startswith(wandb_escape):
             raise NameError(f"{wandb_escape} is a reserved prefix")
 
-    for arg in sys.argv[1:]:
-        assert arg[:2] == "--"
-        k, v = arg[2:].split("=")
-        k = k.lstrip(wandb_escape)
-        v = _cast_param(v)
+    # locals() also holds imports, functions and the like, only the hyperparameters make it to the schema
+    params = {k: v for k, v in config_params.items() if _valid_hyperparam(k, v) and k != "_extra_modules_"}
+    schema = _Schema(params, wandb_escape)
+    for k, v in schema.parse(sys.argv[1:]).items():
+        _set_param(config_params, k, v)
 
-        if k not in config_params.keys():
-            raise ValueError(f"Trying to set {k}, but that's not one of {list(config_params.keys())}")
-        config_params[k] = v
-    # TODO: should only register valid_hyperparams()
-    hyperparams = config_params.copy()
+    hyperparams = {k: v for k, v in config_params.items() if _valid_hyperparam(k, v)}
+    return schema.build({k: hyperparams[k] for k in params})
 
 
-def _cast_param(v):
-    try:
-        return ast.literal_eval(v)
-    except ValueError:
-        return v
-    except SyntaxError:
-        return v
+def _set_param(config_params, key, value):
+    """ Sets key, dotted keys (optim.lr) address nested dicts. """
+    *parents, leaf = key.split(".")
+    params = config_params
+    for parent in parents:
+        params = params.get(parent)
+        if not isinstance(params, dict):
+            raise ValueError(f"Trying to set {key}, but {parent} is not a nested parameter")
+    if leaf not in params.keys():
+        raise ValueError(f"Trying to set {key}, but that's not one of {list(params.keys())}")
+    params[leaf] = value
 
 
 def _valid_hyperparam(key, value):
@@ -72,86 +77,272 @@ def _valid_hyperparam(key, value):
     return True
 
 
+def _flatten_params(params, prefix=""):
+    """ {wandb name: str(value)} of the valid hyperparameters, nested dicts become dotted names: ^optim.lr """
+    flat = {}
+    for name, value in params.items():
+        if not _valid_hyperparam(name, value):
+            continue
+
+        if name == "_extra_modules_":
+            for module in value:
+                module_params = {k: v for k, v in vars(module).items() if not isinstance(v, (type, types.BuiltinFunctionType))}
+                flat.update(_flatten_params(module_params, prefix=module.__name__.replace(".", "_")))
+        elif isinstance(value, dict):
+            flat.update(_flatten_params({f"{name}.{k}": v for k, v in value.items()}, prefix=prefix))
+        else:
+            flat[prefix + wandb_escape + name] = str(value)
+    return flat
+
+
 class WandbWrapper:
-    def __init__(self, experiment_id, project_name, entity=None, local_tensorboard=None):
-        # proj name is git root folder name
-        print(f"wandb.init(project={project_name}, name={experiment_id})")
+    def __init__(self, experiment_id, project_name, entity=None, local_tensorboard=None, buffered=False, flush_interval=1.,
+                 max_queue=10_000, deferred=False, sync_every=100, reductions=None, histogram_bins=64, histogram_sampling=None,
+                 histogram_sample_size=2 ** 16, histogram_range=None, async_objects=False, objects_in_flight=2,
+                 keep_objects=None, compress_objects=False, async_figures=False, figure_workers=2, max_pending_figures=8,
+                 spool=False):
+        # spool: nothing talks to wandb, events are appended to a local spool that `python -m mila_tools.spool sync`
+        # replays later, for nodes without (reliable) network access
+        self.spool = spool
+        if spool:
+            from .spool import _SpoolRun
+            self.run = _SpoolRun(os.path.join(ARTIFACTS_PATH, "spool/"), project_name, experiment_id, entity)
+            print(f"spooling {experiment_id} to {self.run.path}")
+        else:
+            import wandb
+
+            # proj name is git root folder name
+            print(f"wandb.init(project={project_name}, name={experiment_id})")
 
-        # Calling wandb.method is equivalent to calling self.run.method
-        # I'd rather to keep explicit tracking of which run this object is following
-        self.run = wandb.init(project=project_name, name=experiment_id, entity=entity)
+            # Calling wandb.method is equivalent to calling self.run.method
+            # I'd rather to keep explicit tracking of which run this object is following
+            from .trace import tracer
+            with tracer.span("wandb_init", category="job"):
+                self.run = wandb.init(project=project_name, name=experiment_id, entity=entity)
 
         self.tensorboard = local_tensorboard
         self.objects_path = os.path.join(ARTIFACTS_PATH, "objects/", self.run.name)
         os.makedirs(self.objects_path, exist_ok=True)
-
-        def register_param(name, value, prefix=""):
-            if not _valid_hyperparam(name, value):
-                return
-
-            if name == "_extra_modules_":
-                for module in value:
-                    for __k in dir(module):
-                        __v = getattr(module, __k)
-                        register_param(__k, __v, prefix=module.__name__.replace(".", "_"))
-            else:
-                name = prefix + wandb_escape + name
-                # if the parameter was not set by a sweep
-                if not name in wandb.config._items:
-                    print(f"setting {name}={str(value)}")
-                    setattr(wandb.config, name, str(value))
+        # async_objects: add_object snapshots to host memory and serializes on a background thread
+        self._objects = _ObjectStore(self.run, self.objects_path, objects_in_flight if async_objects else 0, keep_objects,
+                                     compress_objects)
+
+        # sweeps set their parameters before we get here, those are kept as they are
+        params = _flatten_params(hyperparams)
+        sweep_params = {k: self.run.config._items[k] for k in params if k in self.run.config._items}
+        for name in sweep_params:
+            print(f"not setting {name} to {params[name]}, because the sweep already set it to {sweep_params[name]}")
+        new_params = {k: v for k, v in params.items() if k not in sweep_params}
+        print(f"setting {len(new_params)} parameters")
+        self.run.config.update(new_params)  # a single config sync
+        record_run(os.path.join(ARTIFACTS_PATH, "params/"), self.run.name, project_name, new_params, sweep_params)
+
+        # seconds-to-first-datapoint, from the start of the job (or of this process) to the first add_scalar
+        self._first_log_pending = True
+
+        # inside a local sweep trial the sweep metric is also reported to the sweep, see local_sweep.run_sweep
+        from .local_sweep import _TrialReporter
+        self._sweep_metric = _TrialReporter.from_environ()
+
+        # buffered: scalars are logged by a background thread, one run.log per step
+        self._scalars = _ScalarPipeline(self.run, self.tensorboard, flush_interval, max_queue) if buffered else None
+
+        # deferred: device arrays are reduced in place and moved to host every sync_every steps or on commit()
+        self._device_metrics = None
+        if deferred:
+            self._device_metrics = _DeviceAccumulator(reductions, histogram_bins, histogram_sampling, histogram_sample_size,
+                                                      histogram_range)
+        self.sync_every = sync_every
+        self._last_sync_step = None
+        self.histogram_bins = histogram_bins
+        self.histogram_sampling = histogram_sampling
+        self.histogram_sample_size = histogram_sample_size
+        self.histogram_range = histogram_range
+        if deferred:
+            atexit.register(self.commit)  # registered after the scalar pipeline, so it runs before the pipeline drains
+
+        # async_figures: figures are rasterized once on a worker pool, the PNG feeds both wandb and tensorboard
+        self._figures = None
+        self._pending_figures = []  # (global_step, tag, future of the wandb media)
+        if async_figures:
+            figures_path = os.path.join(ARTIFACTS_PATH, "figures/", self.run.name)
+            self._figures = _FigureRenderer(figures_path, self._image, self.tensorboard, figure_workers, max_pending_figures)
+            atexit.register(self.flush)
+
+    def flush(self):
+        """ Block until everything logged so far reached wandb and tensorboard. """
+        if self._scalars:
+            self._scalars.flush()
+        self._log_figures()
+
+    def _log_media(self, tag, media, global_step, write_tensorboard=None):
+        """ media is a wandb object, or the future of one from the figure workers, write_tensorboard() logs it to
+            tensorboard. With buffered=True both go through the scalar queue, the worker logs them in step order without
+            holding up the training thread.
+        """
+        if self._scalars:
+            self._scalars.put_media(tag, media, global_step, write_tensorboard)
+            return
+
+        self._log_figures(before_step=global_step)
+        if isinstance(media, concurrent.futures.Future):
+            self._pending_figures.append((global_step, tag, media))
+            return
+        self.run.log({tag: media}, step=global_step, commit=False)
+        if write_tensorboard is not None:
+            write_tensorboard()
+
+    def _log_figures(self, before_step=None):
+        """ wandb drops data logged for a step older than the last one: pending figures, waited for if needed, are logged
+            before anything for a later step.
+        """
+        if not self._pending_figures:
+            return
+        ready = [p for p in self._pending_figures if before_step is None or p[0] < before_step]
+        if not ready:
+            return
+        self._pending_figures = [p for p in self._pending_figures if not (before_step is None or p[0] < before_step)]
+        for global_step, tag, media in ready:
+            self.run.log({tag: media.result()}, step=global_step, commit=False)
+
+    def commit(self):
+        """ Transfer the deferred metrics to host and log them. """
+        if self._device_metrics is None:
+            return
+        for global_step, row in sorted(self._device_metrics.drain().items()):
+            for tag, value in row.items():
+                if isinstance(value, HistogramStats):
+                    self._log_histogram(tag, value, global_step)
                 else:
-                    print(
-                        f"not setting {name} to {str(value)}, str because its already {getattr(wandb.config, name)}, {type(getattr(wandb.config, name))}")
+                    self._log_scalar(tag, value, global_step)
 
-        for k, v in hyperparams.items():
-            register_param(k, v)
+    def _maybe_commit(self, global_step):
+        if self._last_sync_step is None:
+            self._last_sync_step = global_step
+        elif global_step - self._last_sync_step >= self.sync_every:
+            self.commit()
+            self._last_sync_step = global_step
 
     def add_scalar(self, tag: str, scalar_value: float, global_step: int):
+        if self._first_log_pending:
+            self._first_log_pending = False
+            from .trace import JOB_START_ENV, PROCESS_START, tracer
+            job_start = os.environ.get(JOB_START_ENV)
+            tracer.record("first_log", int(job_start) / 1e6 if job_start else PROCESS_START, time.time(), category="job")
+        if self._pending_figures:
+            self._log_figures(before_step=global_step)
+        if self._device_metrics is not None:
+            self._device_metrics.add_scalar(tag, scalar_value, global_step)
+            self._maybe_commit(global_step)
+        else:
+            self._log_scalar(tag, scalar_value, global_step)
+
+    def _log_scalar(self, tag, scalar_value, global_step):
+        if self._sweep_metric and tag == self._sweep_metric.name:
+            self._sweep_metric.report(scalar_value, global_step)
+        if self._scalars:
+            self._scalars.put(tag, scalar_value, global_step)
+            return
+
         scalar_value = float(scalar_value)  # silently remove extra data such as torch gradients
         self.run.log({tag: scalar_value}, step=global_step, commit=False)
         if self.tensorboard:
             self.tensorboard.add_scalar(tag, scalar_value, global_step=global_step)
 
     def add_figure(self, tag, figure, global_step, close=True):
-        self.run.log({tag: figure}, global_step)
+        import matplotlib.pyplot as plt
+
+        if self._figures:
+            self._log_media(tag, self._figures.figure(tag, figure, global_step), global_step)
+            if close:
+                plt.close(figure)  # the worker renders a copy
+            return
+
+        if self.spool:  # figures do not pickle, the spool keeps the rendered PNG
+            figures_path = os.path.join(ARTIFACTS_PATH, "figures/", self.run.name)
+            os.makedirs(figures_path, exist_ok=True)
+            local_path = os.path.join(figures_path, f"{tag.replace('/', '_')}-{global_step}.png")
+            figure.savefig(local_path, format="png")
+            self._log_media(tag, self._image(local_path), global_step)
+        elif self._scalars:
+            self._log_media(tag, self._image(figure), global_step)  # rendered here, matplotlib stays on this thread
+        else:
+            self._log_media(tag, figure, global_step)
         if close:
             plt.close(figure)
 
         if self.tensorboard:
             self.tensorboard.add_figure(tag, figure, global_step=None, close=True)
 
-    def add_histogram(self, tag, values, global_step):
-        wandb.log({tag: wandb.Histogram(values)}, step=global_step, commit=False)
+    def add_histogram(self, tag, values, global_step, sampling=None, sample_size=None, value_range=None):
+        """ sampling is one of metrics.HISTOGRAM_SAMPLING, it defaults to the histogram_sampling of the wrapper, as
+            value_range, the (low, high) edges "streaming" bins between, defaults to histogram_range.
+        """
+        if self._device_metrics is not None:
+            self._device_metrics.add_histogram(tag, values, global_step, sampling, sample_size, value_range)
+            self._maybe_commit(global_step)
+            return
+
+        # binned once, the same counts go to wandb and tensorboard
+        stats = _device_histogram(values, self.histogram_bins, sampling or self.histogram_sampling,
+                                  sample_size or self.histogram_sample_size,
+                                  value_range=value_range or self.histogram_range)
+        self._log_histogram(tag, HistogramStats.from_device(*stats), global_step)
+
+    def _image(self, data):
+        """ wandb media for an image path or array, spooled as is. """
+        if self.spool:
+            from .spool import SpooledImage
+            return SpooledImage(data)
+        import wandb
+        return wandb.Image(data)
+
+    def _log_histogram(self, tag, stats, global_step):
+        if self.spool:
+            histogram = stats
+        else:
+            import wandb
+            histogram = wandb.Histogram(np_histogram=(stats.counts, stats.edges))
+        write_tensorboard = None
         if self.tensorboard:
-            self.tensorboard.add_histogram(tag, values, global_step=None)
+            write_tensorboard = functools.partial(
+                self.tensorboard.add_histogram_raw, tag, min=stats.edges[0], max=stats.edges[-1], num=stats.num,
+                sum=stats.sum, sum_squares=stats.sum_squares, bucket_limits=stats.edges[1:].tolist(),
+                bucket_counts=stats.counts.tolist(), global_step=global_step)
+        self._log_media(tag, histogram, global_step, write_tensorboard)
 
     def plot(self, tag, values, global_step):
-        wandb.log({tag: wandb.Image(values)}, step=global_step, commit=False)
+        self._log_media(tag, self._figures.image(values) if self._figures else self._image(values), global_step)
 
     def add_object(self, tag, obj, global_step):
+        """ Returns the local path of the checkpoint, or a Future of it with async_objects. Modules and optimizers, also
+            inside dicts, lists and tuples, are saved as their state_dict on the host.
+        """
         if not TORCH_ENABLED:
             raise NotImplementedError
+        return self._objects.save(tag, obj, global_step)
 
-        local_path = os.path.join(self.objects_path, f"{tag}-{global_step}.pt")
-        with open(local_path, "wb") as fout:
-            try:
-                torch.save(obj, fout, pickle_module=cloudpickle)
-            except Exception as e:
-                raise e
-
-        self.run.save(local_path, base_path=self.objects_path)
-        return local_path
+    def wait_objects(self):
+        """ Blocks until the checkpoints still being written with async_objects are done. """
+        self._objects.wait()
 
     def watch(self, *args, **kwargs):
         self.run.watch(*args, **kwargs)
 
 
-def deploy(host: str = "", sweep_yaml: str = "", proc_num: int = 1, entity=None, extra_slurm_headers="") -> WandbWrapper:
+def deploy(host: str = "", sweep_yaml: str = "", proc_num: int = 1, entity=None, extra_slurm_headers="", wandb_kwargs=None,
+           submit_workers=8, submit_interval=0., max_snapshot_file_size=None, agents_per_job=1, local_workers=None,
+           scheduler="slurm") -> WandbWrapper:
+    """ scheduler is one of schedulers.SCHEDULERS, host="localhost" runs its commands on this machine without ssh. """
+    from .schedulers import JOB_ID_ENVS, SCHEDULERS
+
     debug = '_pydev_bundle.pydev_log' in sys.modules.keys() and not os.environ.get('BUDDY_DEBUG_DEPLOYMENT', False)
-    is_running_remotely = "SLURM_JOB_ID" in os.environ.keys()
+    job_id = next((os.environ[env] for env in JOB_ID_ENVS if env in os.environ), None)
+    is_running_remotely = job_id is not None
     local_run = not host
+    wandb_kwargs = wandb_kwargs or {}
 
+    import git
     try:
         git_repo = git.Repo()
     except git.InvalidGitRepositoryError:
@@ -159,36 +350,60 @@ def deploy(host: str = "", sweep_yaml: str = "", proc_num: int = 1, entity=None,
 
     project_name = git_repo.remotes.origin.url.split('.git')[0].split('/')[-1]
 
-    if local_run and sweep_yaml:
-        raise NotImplemented("Local sweeps are not supported")
+    from .local_sweep import TRIAL_NAME_ENV
+    if local_run and sweep_yaml and TRIAL_NAME_ENV in os.environ:
+        return WandbWrapper(os.environ[TRIAL_NAME_ENV], project_name=project_name, entity=entity, **wandb_kwargs)
+
+    if agents_per_job > 1 and not sweep_yaml:
+        raise ValueError("agents_per_job requires a sweep_yaml")
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {scheduler}, expected one of {list(SCHEDULERS)}")
 
     if is_running_remotely:
         print("using wandb")
         experiment_id = f"{git_repo.head.commit.message.strip()}"
         jid = datetime.datetime.now().strftime("%b%d_%H-%M-%S")
-        jid += os.environ.get("SLURM_JOB_ID", "")
-        # TODO: turn into a big switch based on scheduler
-        return WandbWrapper(f"{experiment_id}_{jid}", project_name=project_name, entity=entity)
+        jid += job_id
+        return WandbWrapper(f"{experiment_id}_{jid}", project_name=project_name, entity=entity, **wandb_kwargs)
 
     dtm = datetime.datetime.now().strftime("%b%d_%H-%M-%S")
     if debug:
         experiment_id = "DEBUG_RUN"
         tb_dir = os.path.join(git_repo.working_dir, ARTIFACTS_PATH, "tensorboard/", experiment_id, dtm)
         return WandbWrapper(f"{experiment_id}_{dtm}", project_name=project_name,
-                            local_tensorboard=_setup_tb(logdir=tb_dir), entity=entity)
+                            local_tensorboard=_setup_tb(logdir=tb_dir), entity=entity, **wandb_kwargs)
 
     experiment_id = _ask_experiment_id(host, sweep_yaml)
     print(f"experiment_id: {experiment_id}")
-    if local_run:
+    if local_run and sweep_yaml:
+        from .local_sweep import run_sweep
+        run_sweep(sweep_yaml, [sys.executable, *_entrypoint_argv()], f"{experiment_id}_{dtm}",
+                  os.path.join(git_repo.working_dir, ARTIFACTS_PATH, "sweeps/"), local_workers)
+        sys.exit()
+    elif local_run:
         tb_dir = os.path.join(git_repo.working_dir, ARTIFACTS_PATH, "tensorboard/", experiment_id, dtm)
-        return WandbWrapper(f"{experiment_id}_{dtm}", project_name=project_name, local_tensorboard=_setup_tb(logdir=tb_dir))
+        return WandbWrapper(f"{experiment_id}_{dtm}", project_name=project_name, local_tensorboard=_setup_tb(logdir=tb_dir), **wandb_kwargs)
     else:
         if experiment_id.endswith("!"):
             extra_slurm_headers += "#SBATCH --partition=main"
-        _commit_and_sendjob(host, experiment_id, sweep_yaml, git_repo, project_name, proc_num, extra_slurm_headers)
+        from .trace import tracer
+        if tracer.path is None:
+            tracer.path = os.path.join(git_repo.working_dir, ARTIFACTS_PATH, "traces/", f"deploy-{experiment_id}_{dtm}.jsonl")
+        with tracer.span("deploy"):
+            _commit_and_sendjob(host, experiment_id, sweep_yaml, git_repo, project_name, proc_num, extra_slurm_headers,
+                                submit_workers, submit_interval, max_snapshot_file_size, agents_per_job, scheduler)
+        print(f"deploy trace: {tracer.path}, see python -m mila_tools.trace")
         sys.exit()
 
 
+def _entrypoint_argv():
+    """ How this script was started, `-m package.module` included, with its own arguments. """
+    spec = getattr(sys.modules["__main__"], "__spec__", None)
+    if spec is not None:
+        return ["-m", spec.name, *sys.argv[1:]]
+    return sys.argv
+
+
 def _ask_experiment_id(cluster, sweep):
     title = f'{"[CLUSTER" if cluster else "[LOCAL"}'
     if sweep:
@@ -211,55 +426,19 @@ def _ask_experiment_id(cluster, sweep):
 
 
 def _setup_tb(logdir):
+    import tensorboardX
+
     print("http://localhost:6006")
     return tensorboardX.SummaryWriter(logdir=logdir)
 
 
 def _open_ssh_session(hostname):
-    """ TODO: move this to utils.py or to a class (better)
-        TODO add time-out for unknown host
-     """
-    kwargs_connection = {
-        "host": hostname
-    }
-    try:
-        kwargs_connection["connect_kwargs"] = {"password": os.environ["BUDDY_PASSWORD"]}
-    except KeyError:
-        pass
-
-    try:
-        ssh_session = fabric.Connection(**kwargs_connection, connect_timeout=10)
-        ssh_session.run("")
-    except SSHException as e:
-        raise SSHException("SSH connection failed!,"
-                           f"Make sure you can successfully run `ssh {hostname}` with no parameters, any parameters should be set in the ssh_config file"
-                           "If you need a password to authenticate set the Environment variable BUDDY_PASSWORD.")
-
-    return ssh_session
-
-
-def _ensure_scripts(hostname, extra_headers):
-    ssh_session = _open_ssh_session(hostname)
-    retr = ssh_session.run("mktemp -d -t experiment_buddy-XXXXXXXXXX")
-    tmp_folder = retr.stdout.strip()
-    for file_path in os.listdir(SCRIPTS_PATH):
-        script_path = SCRIPTS_PATH + file_path
-        if extra_headers and file_path in ("localenv_sweep.sh", "srun_python.sh"):
-            with open(SCRIPTS_PATH + file_path) as fin:
-                rows = fin.readlines()
-
-            script_path = "/tmp/" + file_path
-            with open(script_path, "w") as fout:
-                for flag_idx in range(1, len(rows)):
-                    old = rows[flag_idx - 1].strip()
-                    new = rows[flag_idx].strip()
-                    if old[:7] in ("#SBATCH", "") and new[:7] not in ("#SBATCH", ""):
-                        rows.insert(flag_idx, "\n" + extra_headers + "\n")
-                        break
-                fout.write("".join(rows))
-
-        ssh_session.put(script_path, tmp_folder + "/")
-    return tmp_folder, ssh_session
+    """ Returns the cached connection to hostname, opening it only if there is no healthy one. """
+    from .schedulers import LOCALHOST, _LocalSession
+    if hostname == LOCALHOST:
+        return _LocalSession()
+    from .ssh import _connections
+    return _connections.get(hostname)
 
 
 def log_cmd(cmd, retr):
@@ -270,53 +449,171 @@ def log_cmd(cmd, retr):
     print("################################################################")
 
 
-def _commit_and_sendjob(hostname, experiment_id, sweep_yaml: str, git_repo, project_name, proc_num, extra_slurm_header):
-    git_url = git_repo.remotes[0].url
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        scripts_folder = executor.submit(_ensure_scripts, hostname, extra_slurm_header)
-        hash_commit = git_sync(experiment_id, git_repo)
+def _environment_key(working_dir):
+    """ Names the cached venv on the cluster: jobs reuse it as long as requirements.txt and the commits its git+
+        requirements resolve to match, activate_cached_venv adds the python version of the job.
+    """
+    key = hashlib.sha256()
+    requirements_path = os.path.join(working_dir, "requirements.txt")
+    if os.path.exists(requirements_path):
+        with open(requirements_path, "rb") as fin:
+            requirements = fin.read()
+        key.update(requirements)
+        for commit in _resolve_vcs_requirements(requirements.decode()):
+            key.update(commit.encode())
+    return key.hexdigest()[:16]
+
+
+def _resolve_vcs_requirements(requirements):
+    """ The commits the git+ requirements point to now, a branch (mila_tools itself, usually) moves without
+        requirements.txt changing. A requirement that cannot be resolved is left out, with a warning.
+    """
+    commits = []
+    for url in re.findall(r"git\+([^\s#]+)", requirements):
+        ref = "HEAD"
+        if "@" in url.rsplit("/", 1)[-1]:
+            url, ref = url.rsplit("@", 1)
+        if re.fullmatch(r"[0-9a-f]{40}", ref):
+            commits.append(ref)
+            continue
+        try:
+            refs = subprocess.check_output(["git", "ls-remote", url, ref], stderr=subprocess.DEVNULL, timeout=30)
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"could not resolve {url}@{ref}, the cached venv is only rebuilt when requirements.txt changes: {e!r}")
+            continue
+        commits.append(refs.decode().split("\t", 1)[0])
+    return commits
+
+
+def _register_sweep(experiment_id, project_name, sweep_yaml, check_output=subprocess.check_output):
+    try:
+        wandb_stdout = check_output(["wandb", "sweep", "--name", experiment_id, "-p", project_name, sweep_yaml], stderr=subprocess.STDOUT).decode("utf-8")
+    except subprocess.CalledProcessError as e:
+        print(e.output.decode("utf-8"))
+        raise e
+    row, = [row for row in wandb_stdout.split("\n") if "Run sweep agent with:" in row]
+    print([row for row in wandb_stdout.split("\n") if "View" in row][0])
+    return row.split()[-1].strip()
+
 
-        entrypoint = os.path.relpath(sys.argv[0], git_repo.working_dir)
+def _cancel_sweep(sweep_id):
+    subprocess.check_output(["wandb", "sweep", "--cancel", sweep_id], stderr=subprocess.STDOUT)
+
+
+def _commit_and_sendjob(hostname, experiment_id, sweep_yaml: str, git_repo, project_name, proc_num, extra_slurm_header,
+                        submit_workers=8, submit_interval=0., max_snapshot_file_size=None, agents_per_job=1,
+                        scheduler="slurm"):
+    import yaml
+
+    from .schedulers import SCHEDULERS
+    from .scripts_cache import ensure_remote_scripts
+
+    git_url = git_repo.remotes[0].url
+    entrypoint = os.path.relpath(sys.argv[0], git_repo.working_dir)
+    if sweep_yaml:
+        with open(sweep_yaml, 'r') as stream:
+            data_loaded = yaml.safe_load(stream)
+
+        if data_loaded["program"] != entrypoint:
+            raise ValueError(f'YAML {data_loaded["program"]} does not match the entrypoint {entrypoint}')
+
+    def submit(ssh_session, scripts_folder, hash_commit, env_key, sweep_id=None):
+        # the job scripts fetch just the snapshot tag, shallow
+        snapshot_tag = _snapshot_tag(git_repo.active_branch.name, hash_commit)
+        # TODO: assert -e git+git@github.com:manuel-delverme/mila_tools.git#egg=mila_tools is in requirements.txt
+        jobs = SCHEDULERS[scheduler](ssh_session)
         if sweep_yaml:
-            with open(sweep_yaml, 'r') as stream:
-                data_loaded = yaml.safe_load(stream)
-
-            if data_loaded["program"] != entrypoint:
-                raise ValueError(f'YAML {data_loaded["program"]} does not match the entrypoint {entrypoint}')
-
-            try:
-                wandb_stdout = subprocess.check_output(["wandb", "sweep", "--name", experiment_id, "-p", project_name, sweep_yaml], stderr=subprocess.STDOUT).decode("utf-8")
-            except subprocess.CalledProcessError as e:
-                print(e.output.decode("utf-8"))
-                raise e
-            row, = [row for row in wandb_stdout.split("\n") if "Run sweep agent with:" in row]
-            print([row for row in wandb_stdout.split("\n") if "View" in row][0])
-            sweep_id = row.split()[-1].strip()
-
-            ssh_args = (git_url, sweep_id, hash_commit)
-            ssh_command = "/opt/slurm/bin/sbatch {0}/localenv_sweep.sh {1} {2} {3}"
+            ssh_command = jobs.batch_command(f"{scripts_folder}/localenv_sweep.sh",
+                                             [git_url, sweep_id, snapshot_tag, env_key, agents_per_job],
+                                             {"MILA_TOOLS_SCRIPTS": scripts_folder})
         else:
-            ssh_args = (git_url, entrypoint, hash_commit)
-            ssh_command = "bash -l {0}/run_experiment.sh {1} {2} {3}"
+            ssh_command = jobs.login_command(f"{scripts_folder}/run_experiment.sh", [git_url, entrypoint, snapshot_tag, env_key])
             print("monitor your run on https://wandb.ai/")
+        print(ssh_command)
+
+        if sweep_yaml and submit_interval == 0:
+            # the agents are identical, let the scheduler expand them
+            return jobs.submit_array(ssh_command, proc_num)
+        # login commands prepare the job on the login node, one round trip each so they run concurrently
+        batch_size = 16 if sweep_yaml else 1
+        return jobs.submit([ssh_command] * proc_num, batch_size=batch_size, max_workers=submit_workers,
+                           submit_interval=submit_interval)
+
+    pipeline = _Pipeline("deploy")
+    pipeline.add("ssh_connect", _open_ssh_session, hostname)
+    pipeline.add("upload_scripts", lambda ssh_session: ensure_remote_scripts(ssh_session, SCRIPTS_PATH, extra_slurm_header),
+                 after=("ssh_connect",))
+    # the subprocesses run through the pipeline, a failing stage terminates them; what got through is then undone
+    pipeline.add("git_sync", git_sync, experiment_id, git_repo, False, max_snapshot_file_size, pipeline.check_output,
+                 rollback=lambda git_hash: _delete_snapshot(git_repo, git_hash))
+    # resolving the git+ requirements is a round trip to their remotes too
+    pipeline.add("environment_key", _environment_key, git_repo.working_dir)
+    submit_after = ("ssh_connect", "upload_scripts", "git_sync", "environment_key")
+    if sweep_yaml:
+        pipeline.add("register_sweep", _register_sweep, experiment_id, project_name, sweep_yaml, pipeline.check_output,
+                     rollback=_cancel_sweep)
+        submit_after += ("register_sweep",)
+    pipeline.add("submit", submit, after=submit_after)
+    return pipeline.run()["submit"]
+
+
+def git_sync(experiment_id, git_repo, in_place=False, max_file_size=None, check_output=subprocess.check_output):
+    """ Commits the working tree as a snapshot/<branch>/<hash> tag and pushes only that tag, returns the commit hash.
+        The commit is built from a temporary index so HEAD, the index and the working tree are left untouched;
+        untracked files larger than max_file_size bytes are left out. in_place=True uses the old checkout/commit/reset dance.
+        The push runs through check_output, see _Pipeline.check_output.
+    """
+    if in_place:
+        return _git_sync_in_place(experiment_id, git_repo)
+
+    from .trace import tracer
+    with tracer.span("git_snapshot"), tempfile.TemporaryDirectory() as tmp_dir:
+        env = {"GIT_INDEX_FILE": os.path.join(tmp_dir, "index")}
+        index_path = os.path.join(git_repo.git_dir, "index")
+        if os.path.exists(index_path):
+            shutil.copyfile(index_path, env["GIT_INDEX_FILE"])  # reuse the stat cache, only changed files get hashed
+        git_repo.git.add("--update", env=env)
+
+        untracked = git_repo.untracked_files
+        if max_file_size is not None:
+            too_large = {f for f in untracked if os.path.getsize(os.path.join(git_repo.working_dir, f)) > max_file_size}
+            for file_path in sorted(too_large):
+                print(f"snapshot: skipping {file_path}, larger than {max_file_size} bytes")
+            untracked = [f for f in untracked if f not in too_large]
+        if untracked:
+            with open(os.path.join(tmp_dir, "untracked"), "w+") as paths:
+                paths.write("\n".join(untracked) + "\n")
+                paths.seek(0)
+                git_repo.git.update_index("--add", "--stdin", istream=paths, env=env)
+
+        tree = git_repo.git.write_tree(env=env)
+        git_hash = git_repo.git.commit_tree(tree, "-p", "HEAD", "-m", experiment_id)
+        tag_name = _snapshot_tag(git_repo.active_branch.name, git_hash)
+        git_repo.git.tag(tag_name, git_hash)
+    with tracer.span("git_push"):
+        # send to online repo
+        check_output(["git", "push", git_repo.remote().name, f"refs/tags/{tag_name}"], cwd=git_repo.working_dir,
+                     stderr=subprocess.STDOUT)
+    return git_hash
+
+
+def _snapshot_tag(branch_name, git_hash):
+    return f"snapshot/{branch_name}/{git_hash}"
+
 
-    # TODO: assert -e git+git@github.com:manuel-delverme/mila_tools.git#egg=mila_tools is in requirements.txt
-    scripts_folder, ssh_session = scripts_folder.result()
-    ssh_command = ssh_command.format(scripts_folder, *ssh_args)
-    print(ssh_command)
-    for proc_num in range(proc_num):
-        print("Running process ", proc_num)
-        time.sleep(1)
-        ssh_session.run(ssh_command)
+def _delete_snapshot(git_repo, git_hash):
+    tag_name = _snapshot_tag(git_repo.active_branch.name, git_hash)
+    git_repo.git.push(git_repo.remote().name, "--delete", f"refs/tags/{tag_name}")
+    git_repo.delete_tag(tag_name)
 
 
-def git_sync(experiment_id, git_repo):
+def _git_sync_in_place(experiment_id, git_repo):
     active_branch = git_repo.active_branch.name
     os.system(f"git checkout --detach")  # move changest to snapshot branch
     os.system(f"git add .")
     os.system(f"git commit -m '{experiment_id}'")
     git_hash = git_repo.commit().hexsha
-    tag_name = f"snapshot/{active_branch}/{git_hash}"
+    tag_name = _snapshot_tag(active_branch, git_hash)
     os.system(f"git tag {tag_name}")
     os.system(f"git push {git_repo.remote()} {tag_name}")  # send to online repo
     os.system(f"git reset HEAD~1")  # untrack the changes
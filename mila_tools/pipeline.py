@@ -0,0 +1,117 @@
+import concurrent.futures
+import subprocess
+import threading
+import time
+
+
+class _Pipeline:
+    """ A tiny dependency graph: every stage starts on a thread as soon as the stages it depends on are done,
+        and receives their results as extra positional arguments.
+        If a stage fails no further stage is started, the subprocesses the running ones started through check_output are
+        terminated and waited for, then the stages that did finish are rolled back, latest first, and the error is raised.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = {}  # stage -> seconds
+        self._stages = {}  # stage -> (fn, args, deps, rollback)
+        self._failed = threading.Event()
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def add(self, stage, fn, *args, after=(), rollback=None):
+        """ rollback(result) undoes the stage, what it left outside of this process, when the pipeline fails. """
+        for dep in after:
+            if dep not in self._stages:
+                raise ValueError(f"{stage} depends on {dep}, which is not a stage of {self.name}")
+        self._stages[stage] = (fn, args, tuple(after), rollback)
+
+    def check_output(self, args, **kwargs):
+        """ subprocess.check_output for the stages, the process is terminated as soon as another stage fails. """
+        with self._lock:
+            if self._failed.is_set():
+                raise RuntimeError(f"{self.name} failed, not running {args}")
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, **kwargs)
+            self._processes.add(process)
+        try:
+            output, _ = process.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, output)
+        return output
+
+    def _cancel(self):
+        with self._lock:
+            self._failed.set()
+            for process in self._processes:
+                process.terminate()
+
+    def _timed(self, stage, fn, *args):
+        from .trace import tracer
+
+        start = time.perf_counter()
+        try:
+            with tracer.span(stage, category=self.name):
+                return fn(*args)
+        finally:
+            self.timings[stage] = time.perf_counter() - start
+            print(f"[{self.name}] {stage} took {self.timings[stage]:.2f}s")
+
+    def _rollback(self, results):
+        for stage in reversed(list(results)):
+            rollback = self._stages[stage][3]
+            if rollback is None:
+                continue
+            print(f"[{self.name}] rolling back {stage}")
+            try:
+                rollback(results[stage])
+            except Exception as e:  # the original error is the one worth raising
+                print(f"[{self.name}] rolling back {stage} failed: {e!r}")
+
+    def run(self):
+        """ Returns {stage: result}. """
+        start = time.perf_counter()
+        results = {}  # in completion order
+        futures = {}  # future -> stage
+        error = None
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self._stages)))
+
+        def launch_ready():
+            launched = set(futures.values())
+            for stage, (fn, args, deps, _) in self._stages.items():
+                if stage not in launched and all(dep in results for dep in deps):
+                    dep_results = tuple(results[dep] for dep in deps)
+                    futures[executor.submit(self._timed, stage, fn, *args, *dep_results)] = stage
+
+        try:
+            launch_ready()
+            finished = set()
+            while len(finished) < len(futures):
+                try:
+                    done, _ = concurrent.futures.wait(set(futures) - finished,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                except BaseException as e:  # KeyboardInterrupt, the running stages are cancelled the same way
+                    error = error or e
+                    self._cancel()
+                    continue
+                for future in done:
+                    finished.add(future)
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                            self._cancel()
+                if error is None:
+                    launch_ready()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        print(f"[{self.name}] total {time.perf_counter() - start:.2f}s")
+        if error is not None:
+            self._rollback(results)
+            raise error
+        return results
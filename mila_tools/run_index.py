@@ -0,0 +1,68 @@
+""" Offline record of the hyperparameters each run registered, one json per run under <ARTIFACTS_PATH>/params/ and an
+append-only index.jsonl listing them.
+"""
+import datetime
+import json
+import os
+
+INDEX_FILE = "index.jsonl"
+
+
+def _run_file(params_path, run_name):
+    """ Run names come from experiment ids and commit messages, a "/" in them is not a folder. """
+    return os.path.join(params_path, f"{run_name.replace('/', '_').replace(os.sep, '_')}.json")
+
+
+def record_run(params_path, run_name, project_name, params, sweep_params):
+    """ params are the flattened parameters pushed to wandb, sweep_params the ones the sweep had already set. """
+    sweep_params = {k: str(v) for k, v in sweep_params.items()}
+    os.makedirs(params_path, exist_ok=True)
+    record = {
+        "run": run_name,
+        "project": project_name,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "params": params,
+        "sweep_params": sweep_params,
+    }
+    run_path = _run_file(params_path, run_name)
+    with open(run_path, "w") as fout:
+        json.dump(record, fout, indent=1, sort_keys=True)
+    with open(os.path.join(params_path, INDEX_FILE), "a") as fout:
+        fout.write(json.dumps({"run": run_name, "project": project_name, "time": record["time"], "path": run_path}) + "\n")
+    return run_path
+
+
+def load_run_params(params_path, run_name):
+    """ All the parameters of a run, the ones set by a sweep included. """
+    with open(_run_file(params_path, run_name)) as fin:
+        record = json.load(fin)
+    return {**record["params"], **record["sweep_params"]}
+
+
+def list_runs(params_path):
+    index_path = os.path.join(params_path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as fin:
+        return [json.loads(row) for row in fin if row.strip()]
+
+
+def diff_runs(params_path, run_a, run_b):
+    """ {name: (value in run_a, value in run_b)} for every parameter that differs, None when missing. """
+    params_a = load_run_params(params_path, run_a)
+    params_b = load_run_params(params_path, run_b)
+    return {k: (params_a.get(k), params_b.get(k)) for k in sorted(params_a.keys() | params_b.keys())
+            if params_a.get(k) != params_b.get(k)}
+
+
+def find_runs(params_path, params):
+    """ Names of the runs whose parameters match all of params, keys as registered on wandb (e.g. "^lr"),
+        values compared as strings.
+    """
+    wanted = {k: str(v) for k, v in params.items()}
+    matches = []
+    for entry in list_runs(params_path):
+        run_params = load_run_params(params_path, entry["run"])
+        if all(run_params.get(k) == v for k, v in wanted.items()):
+            matches.append(entry["run"])
+    return matches
@@ -0,0 +1,325 @@
+""" Where the jobs of a deploy run. A scheduler wraps a session, a fabric.Connection or _LocalSession for this machine,
+and every call is a single round trip however many jobs it covers:
+
+    submit(commands) -> [SubmittedJob], status(job_ids) -> {job_id: state}, cancel(job_ids)
+
+batch_command turns a job script into a command for submit, login_command a script that prepares the job on the login
+node and then submits it through $MILA_TOOLS_SBATCH (run_experiment.sh).
+"""
+import collections
+import concurrent.futures
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+STATES = ("PENDING", "RUNNING", "COMPLETED", "FAILED", "CANCELLED", "UNKNOWN")
+JOB_ID_ENVS = ("SLURM_JOB_ID", "MILA_TOOLS_JOB_ID")  # set inside a job, by SLURM or by ProcessScheduler
+LOCALHOST = "localhost"  # deploy(host=LOCALHOST) runs the scheduler commands on this machine, without ssh
+_MARKER = "@@mila_tools"
+
+SubmittedJob = collections.namedtuple("SubmittedJob", "index job_id error")
+
+
+class _LocalSession:
+    """ The subset of fabric.Connection the schedulers and scripts_cache use, for this machine. """
+    host = LOCALHOST
+
+    def run(self, command, hide=True):
+        retr = subprocess.run(["bash", "-c", command], capture_output=hide, text=True)
+        if retr.returncode != 0:
+            raise subprocess.CalledProcessError(retr.returncode, command, retr.stdout, retr.stderr)
+        return retr
+
+    def put(self, local, remote):
+        """ remote paths are relative to the home folder, as with sftp """
+        remote = os.path.join(os.path.expanduser("~"), remote)
+        if hasattr(local, "read"):
+            with open(remote, "wb") as fout:
+                shutil.copyfileobj(local, fout)
+        else:
+            shutil.copyfile(local, remote)
+
+
+def _transient_errors(session):
+    """ errors worth a retry: the connection or the channel could not be opened, the command never ran. A session that
+        dies once the command started is not retried, it may have gone through (an sbatch with no job id reported).
+    """
+    if isinstance(session, _LocalSession):
+        return ()
+    if hasattr(session, "transient_errors"):
+        return session.transient_errors
+    from paramiko.ssh_exception import ChannelException, NoValidConnectionsError
+    return ChannelException, NoValidConnectionsError
+
+
+class _RateLimiter:
+    """ Spaces calls at least `interval` seconds apart, across threads. """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _quote(value):
+    """ shlex.quote, except for a leading $HOME/ left to the remote shell: scripts_cache paths are relative to it. """
+    value = str(value)
+    if value.startswith("$HOME/"):
+        return f'"$HOME"/{shlex.quote(value[len("$HOME/"):])}'
+    return shlex.quote(value)
+
+
+def _env_prefix(env):
+    return "".join(f"{k}={_quote(v)} " for k, v in (env or {}).items())
+
+
+def _expand_ids(job_id):
+    """ 12_[0-2,5%2] -> [12_0, 12_1, 12_2, 12_5], how squeue shows the pending tasks of an array. """
+    match = re.fullmatch(r"(\d+)_\[([^\]%]+)(%\d+)?\]", job_id)
+    if not match:
+        return [job_id]
+    ids = []
+    for part in match.group(2).split(","):
+        first, _, last = part.partition("-")
+        ids.extend(f"{match.group(1)}_{task}" for task in range(int(first), int(last or first) + 1))
+    return ids
+
+
+class _Scheduler:
+    job_id_pattern = None  # how the submission output reports the job id
+
+    def __init__(self, session, retries=3):
+        self.session = session
+        self.retries = retries
+        self._transient_errors = _transient_errors(session)
+
+    def _run(self, command, backoff=1.):
+        retries = self.retries
+        for attempt in range(retries + 1):
+            try:
+                return self.session.run(command, hide=True)
+            except self._transient_errors as e:
+                if attempt == retries:
+                    raise
+                delay = backoff * 2 ** attempt
+                print(f"transient ssh error {e!r} while running `{command}`, retrying in {delay}s")
+                time.sleep(delay)
+
+    def batch_command(self, script, args, env=None):
+        raise NotImplementedError
+
+    def login_command(self, script, args, env=None):
+        raise NotImplementedError
+
+    def _job_id(self, output):
+        job_ids = self.job_id_pattern.findall(output)
+        return job_ids[-1] if job_ids else None
+
+    def _submit_batch(self, indices, commands):
+        """ One round trip for all the commands, each one's output and exit status delimited by markers. It is retried
+            only if it never started: the session can die after some commands went through, rerunning them would submit
+            them twice, so they are all reported failed instead.
+        """
+        script = "; ".join(f'echo "{_MARKER} {index}"; ({command}) 2>&1; echo "{_MARKER}-exit $?"'
+                           for index, command in zip(indices, commands))
+        try:
+            stdout = self._run(script).stdout
+        except Exception as e:
+            return [SubmittedJob(index, None, e) for index in indices]
+
+        outputs, exits = {}, {}
+        index = None
+        for row in stdout.splitlines():
+            if row.startswith(f"{_MARKER}-exit "):
+                exits[index] = int(row.split()[1])
+            elif row.startswith(f"{_MARKER} "):
+                index = int(row.split()[1])
+                outputs[index] = []
+            elif index is not None:
+                outputs[index].append(row)
+
+        jobs = []
+        for index in indices:
+            output = "\n".join(outputs.get(index, ()))
+            if exits.get(index, 1) != 0:
+                jobs.append(SubmittedJob(index, None, RuntimeError(f"submission exited with {exits.get(index)}: {output}")))
+            else:
+                jobs.append(SubmittedJob(index, self._job_id(output), None))
+        return jobs
+
+    def _submit(self, commands, batch_size, max_workers, submit_interval):
+        if submit_interval:
+            batch_size = 1  # the interval spaces every single submission
+        rate_limiter = _RateLimiter(submit_interval)
+        batches = [range(start, min(start + batch_size, len(commands))) for start in range(0, len(commands), batch_size)]
+
+        def submit(indices):
+            rate_limiter.wait()
+            return self._submit_batch(indices, [commands[index] for index in indices])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            return [job for batch in executor.map(submit, batches) for job in batch]
+
+    def submit(self, commands, batch_size=16, max_workers=8, submit_interval=0.):
+        """ Submits batch_size commands per round trip, the batches concurrently, each on its own channel of the session.
+            The commands of a batch run one after the other, login_commands (fetch, venv, then sbatch) want batch_size=1.
+            Returns one SubmittedJob per command, failed submissions carry the exception instead of a job id.
+        """
+        jobs = self._submit(commands, batch_size, max_workers, submit_interval)
+        _report(jobs)
+        return jobs
+
+    def submit_array(self, command, count):
+        """ count copies of a batch_command. """
+        return self.submit([command] * count)
+
+    def status(self, job_ids):
+        raise NotImplementedError
+
+    def cancel(self, job_ids):
+        raise NotImplementedError
+
+
+class SlurmScheduler(_Scheduler):
+    job_id_pattern = re.compile(r"Submitted batch job (\d+)")
+    # sacct states that end a job without completing it
+    _FAILED = ("TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE")
+
+    def __init__(self, session, retries=3, slurm_bin=None):
+        super().__init__(session, retries)
+        # BUDDY_SLURM_BIN can point to the commands of fake_slurm
+        self.slurm_bin = slurm_bin or os.environ.get("BUDDY_SLURM_BIN", "/opt/slurm/bin")
+        self.sbatch = f"{self.slurm_bin}/sbatch"
+
+    def batch_command(self, script, args, env=None):
+        export = "".join(f",{k}={_quote(v)}" for k, v in (env or {}).items())
+        return f"{self.sbatch} --export=ALL{export} {script} {' '.join(map(str, args))}"
+
+    def login_command(self, script, args, env=None):
+        env = {"MILA_TOOLS_SBATCH": self.sbatch, **(env or {})}
+        return f"{_env_prefix(env)}bash -l {script} {' '.join(map(str, args))}"
+
+    def submit_array(self, command, count):
+        """ A single job array, the scheduler expands the identical jobs itself. """
+        if not command.startswith(f"{self.sbatch} "):
+            raise ValueError(f"job arrays need a batch_command, got {command}")
+        array_command = f"{self.sbatch} --array=0-{count - 1} {command[len(self.sbatch) + 1:]}"
+        array_job, = self._submit([array_command], batch_size=1, max_workers=1, submit_interval=0.)
+        jobs = [SubmittedJob(index, array_job.job_id and f"{array_job.job_id}_{index}", array_job.error)
+                for index in range(count)]
+        _report(jobs)
+        return jobs
+
+    def _state(self, state):
+        state = state.split()[0] if state else "UNKNOWN"
+        if state in ("CONFIGURING", "COMPLETING", "SUSPENDED", "STOPPED"):
+            return "RUNNING"
+        if state in self._FAILED:
+            return "FAILED"
+        return state if state in STATES else "UNKNOWN"
+
+    def status(self, job_ids):
+        """ squeue knows the queued and running jobs, sacct (when accounting is enabled) the finished ones. """
+        ids = ",".join(job_ids)
+        stdout = self._run(f'{self.slurm_bin}/squeue -h -u "$USER" -o "%i %T"; echo {_MARKER}; '
+                           f'{self.slurm_bin}/sacct -n -X -P -o JobID,State -j {ids} 2>/dev/null || true').stdout
+        queued, _, accounted = stdout.partition(f"{_MARKER}\n")
+        states = {job_id: "UNKNOWN" for job_id in job_ids}
+        for row in accounted.splitlines():
+            job_id, _, state = row.partition("|")
+            if job_id in states:
+                states[job_id] = self._state(state)
+        for row in queued.splitlines():
+            job_id, _, state = row.strip().partition(" ")
+            for expanded in _expand_ids(job_id):
+                if expanded in states:
+                    states[expanded] = self._state(state)
+        return states
+
+    def cancel(self, job_ids):
+        self._run(f"{self.slurm_bin}/scancel {' '.join(job_ids)}")
+
+
+class ProcessScheduler(_Scheduler):
+    """ Jobs are background processes on the host, for machines without a scheduler. A job id is the process group of
+        the job, its output and exit status are kept in JOBS_PATH on the host.
+    """
+    JOBS_PATH = "$HOME/.cache/mila_tools/jobs"
+    job_id_pattern = re.compile(r"Started job (\d+)")
+
+    def batch_command(self, script, args, env=None):
+        # setsid makes the job a process group of its own, so cancel reaches whatever it started; without job control
+        # the background process is not a group leader, setsid execs in place and $! is the job's $$
+        job = (f"export MILA_TOOLS_JOB_ID=$$; exec > {self.JOBS_PATH}/$$.log 2>&1; "
+               f"{_env_prefix(env)}bash {script} {' '.join(shlex.quote(str(arg)) for arg in args)}; "
+               f"echo $? > {self.JOBS_PATH}/$$.status")
+        return (f'mkdir -p {self.JOBS_PATH} && {{ setsid bash -c {shlex.quote(job)} < /dev/null > /dev/null 2>&1 & }} && '
+                f'echo "Started job $!"')
+
+    def login_command(self, script, args, env=None):
+        # there is no queue to hand the job to, run_experiment.sh runs it in place
+        return self.batch_command(script, args, {"MILA_TOOLS_SBATCH": "bash", **(env or {})})
+
+    def status(self, job_ids):
+        stdout = self._run(
+            f'for pid in {" ".join(job_ids)}; do '
+            f'if ps -o stat= -p "$pid" | grep -qv Z; then echo "$pid RUNNING"; '  # an unreaped job is a zombie
+            f'elif [ -f "{self.JOBS_PATH}/$pid.status" ]; then echo "$pid $(cat "{self.JOBS_PATH}/$pid.status")"; '
+            f'else echo "$pid CANCELLED"; fi; done').stdout
+        states = {job_id: "UNKNOWN" for job_id in job_ids}
+        for row in stdout.splitlines():
+            job_id, _, state = row.partition(" ")
+            if state.isdigit():
+                state = "COMPLETED" if state == "0" else "FAILED"
+            states[job_id] = state or "RUNNING"  # the status file is being written
+        return states
+
+    def cancel(self, job_ids):
+        self._run(" ".join(f"kill -TERM -- -{job_id} 2>/dev/null;" for job_id in job_ids) + " true")
+
+
+class LocalScheduler(ProcessScheduler):
+    """ Background processes on this machine. """
+
+    def __init__(self, retries=3):
+        super().__init__(_LocalSession(), retries)
+
+
+SCHEDULERS = {
+    "slurm": SlurmScheduler,
+    "ssh": ProcessScheduler,
+}
+
+
+def wait_jobs(scheduler, job_ids, poll_interval=5., timeout=None):
+    """ Polls until every job is COMPLETED, FAILED or CANCELLED, returns their last states. """
+    deadline = timeout and time.monotonic() + timeout
+    while True:
+        states = scheduler.status(job_ids)
+        if all(state in ("COMPLETED", "FAILED", "CANCELLED") for state in states.values()):
+            return states
+        if deadline and time.monotonic() > deadline:
+            raise TimeoutError(f"jobs still running after {timeout}s: {states}")
+        time.sleep(poll_interval)
+
+
+def _report(jobs):
+    for job in jobs:
+        if job.error is None:
+            print(f"job {job.index}: submitted {job.job_id or '(no job id)'}")
+        else:
+            print(f"job {job.index}: failed with {job.error!r}")
+    if jobs and all(job.error is not None for job in jobs):
+        raise RuntimeError(f"All {len(jobs)} submissions failed") from jobs[0].error
@@ -0,0 +1,105 @@
+""" Typed view of the registered parameters: the type of each parameter is inferred once from its default, the argv
+overrides are parsed in one pass with a caster per parameter, and the result is a frozen Config.
+
+Config classes are namedtuples, attribute reads are as cheap as they get and instances pickle as (fields, values) even
+though the classes are built at runtime, so they can be sent to worker processes.
+"""
+import ast
+import collections
+import functools
+import keyword
+
+
+def _cast_param(v):
+    """ Parameters without a usable type (None, containers, ...) take whatever python literal the value is. """
+    try:
+        return ast.literal_eval(v)
+    except ValueError:
+        return v
+    except SyntaxError:
+        return v
+
+
+_BOOLS = {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}
+
+
+def _to_bool(v):
+    try:
+        return _BOOLS[v.lower()]
+    except KeyError:
+        raise ValueError(f"{v!r} is not a boolean") from None
+
+
+def _to_int(v):
+    try:
+        return int(v)
+    except ValueError:
+        as_float = float(v)  # sweeps send integral floats as well: 5e4, 100.0
+        if not as_float.is_integer():
+            raise ValueError(f"{v!r} is not an integer") from None
+        return int(as_float)
+
+
+# by exact type, bool is an int
+_CASTERS = {bool: _to_bool, int: _to_int, float: float, str: str}
+
+
+@functools.lru_cache(maxsize=None)
+def _config_class(fields):
+    class Config(collections.namedtuple("Config", fields)):
+        """ Frozen registered parameters, nested dicts are nested Configs. """
+        __slots__ = ()
+
+        def __reduce__(self):
+            return _config, (self._fields, tuple(self))
+
+    return Config
+
+
+def _config(fields, values):
+    return _config_class(fields)(*values)
+
+
+class _Schema:
+    """ {dotted name: caster} of the parameters in defaults, nested dicts included. """
+
+    def __init__(self, defaults, escape="^"):
+        self.escape = escape
+        self._casters = {}
+        self._add(defaults, prefix="")
+
+    def _add(self, params, prefix):
+        for name, default in params.items():
+            if isinstance(default, dict):
+                self._add(default, prefix=f"{prefix}{name}.")
+            else:
+                self._casters[prefix + name] = _CASTERS.get(type(default), _cast_param)
+
+    def parse(self, argv):
+        """ {dotted name: value} of the --name=value (or --^name=value) arguments, --flag sets a boolean. """
+        overrides = {}
+        for arg in argv:
+            if not arg.startswith("--"):
+                raise ValueError(f"Expected --name=value, got {arg}")
+            key, has_value, value = arg[2:].partition("=")  # values can contain "="
+            key = key.lstrip(self.escape)
+            caster = self._casters.get(key)
+            if caster is None:
+                raise ValueError(f"Trying to set {key}, but that's not one of {list(self._casters)}")
+            if not has_value:
+                if caster is not _to_bool:
+                    raise ValueError(f"{key} needs a value: --{key}=...")
+                value = "true"
+            try:
+                overrides[key] = caster(value)
+            except ValueError as e:
+                raise ValueError(f"Could not parse --{key}={value}: {e}") from None
+        return overrides
+
+    @classmethod
+    def build(cls, params):
+        """ The Config of params, nested dicts become nested Configs. Names that cannot be attributes (_private, class,
+            lr-decay) are left out, they are still overridden and logged.
+        """
+        params = {k: v for k, v in params.items() if k.isidentifier() and not keyword.iskeyword(k) and not k.startswith("_")}
+        return _config(tuple(params), tuple(cls.build(v) if isinstance(v, dict) else v for v in params.values()))
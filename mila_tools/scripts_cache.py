@@ -0,0 +1,111 @@
+""" Content addressed copy of slurm_scripts on the cluster.
+
+The scripts, after the extra slurm headers are injected, are hashed locally; the remote folder is named after the hash
+so a deploy only uploads when that exact set of scripts was never seen by the cluster.
+
+    python -m mila_tools.scripts_cache <host> [--max-age-days N]
+
+removes the entries that were not used by any deploy in the last N days.
+"""
+import argparse
+import hashlib
+import io
+import os
+import tarfile
+
+REMOTE_CACHE = "$HOME/.cache/mila_tools/scripts"
+HEADER_SCRIPTS = ("localenv_sweep.sh", "srun_python.sh")
+
+
+def _inject_headers(rows, extra_headers):
+    """ Inserts extra_headers after the #SBATCH block. """
+    rows = list(rows)
+    for flag_idx in range(1, len(rows)):
+        old = rows[flag_idx - 1].strip()
+        new = rows[flag_idx].strip()
+        if old[:7] in ("#SBATCH", "") and new[:7] not in ("#SBATCH", ""):
+            rows.insert(flag_idx, "\n" + extra_headers + "\n")
+            break
+    return "".join(rows)
+
+
+def _render_scripts(scripts_path, extra_headers):
+    scripts = {}
+    for file_name in sorted(os.listdir(scripts_path)):
+        file_path = os.path.join(scripts_path, file_name)
+        if not os.path.isfile(file_path):
+            continue
+        with open(file_path) as fin:
+            rows = fin.readlines()
+        if extra_headers and file_name in HEADER_SCRIPTS:
+            scripts[file_name] = _inject_headers(rows, extra_headers).encode()
+        else:
+            scripts[file_name] = "".join(rows).encode()
+    return scripts
+
+
+def _digest(scripts):
+    h = hashlib.sha256()
+    for file_name, content in sorted(scripts.items()):
+        h.update(file_name.encode() + b"\0" + hashlib.sha256(content).digest())
+    return h.hexdigest()[:16]
+
+
+def _tarball(scripts):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for file_name, content in scripts.items():
+            info = tarfile.TarInfo(file_name)
+            info.size = len(content)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(content))
+    buffer.seek(0)
+    return buffer
+
+
+def ensure_remote_scripts(ssh_session, scripts_path, extra_headers):
+    """ Returns the remote folder holding the rendered scripts, uploading them only on a cache miss. """
+    scripts = _render_scripts(scripts_path, extra_headers)
+    digest = _digest(scripts)
+    remote_folder = f"{REMOTE_CACHE}/{digest}"
+
+    # touch keeps the entry fresh for clean_remote_scripts
+    retr = ssh_session.run(f'test -d "{remote_folder}" && touch "{remote_folder}" && echo hit || true', hide=True)
+    if retr.stdout.strip() == "hit":
+        return remote_folder
+
+    # sftp paths are relative to the remote home
+    tarball = f"mila_tools-scripts-{digest}.tar.gz"
+    ssh_session.put(_tarball(scripts), tarball)
+    # extract aside and rename, concurrent deploys of the same scripts leave a single complete folder
+    ssh_session.run(
+        f'mkdir -p "{REMOTE_CACHE}" && staging=$(mktemp -d "{REMOTE_CACHE}/.staging-XXXXXXXXXX") && '
+        f'tar -xzf "$HOME/{tarball}" -C "$staging" && rm -f "$HOME/{tarball}" && '
+        f'(mv -T "$staging" "{remote_folder}" 2>/dev/null || rm -rf "$staging")', hide=True)
+    return remote_folder
+
+
+def clean_remote_scripts(ssh_session, max_age_days=30):
+    """ Removes cached script folders, and leftover staging folders, unused for more than max_age_days. """
+    retr = ssh_session.run(
+        f'test -d "{REMOTE_CACHE}" && find "{REMOTE_CACHE}" -mindepth 1 -maxdepth 1 -type d -mtime +{int(max_age_days)} '
+        f'-print -exec rm -rf {{}} + || true', hide=True)
+    return retr.stdout.split()
+
+
+def main():
+    from .ssh import _connections
+
+    parser = argparse.ArgumentParser(description="Remove stale slurm_scripts entries from the cluster cache")
+    parser.add_argument("host")
+    parser.add_argument("--max-age-days", type=int, default=30)
+    args = parser.parse_args()
+
+    removed = clean_remote_scripts(_connections.get(args.host), args.max_age_days)
+    print(f"removed {len(removed)} entries")
+    for remote_folder in removed:
+        print(remote_folder)
+
+
+if __name__ == "__main__":
+    main()
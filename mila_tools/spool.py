@@ -0,0 +1,225 @@
+""" Offline-first logging: runs append their events to a local spool, a separate process replays them to wandb.
+
+Each run gets a folder under <ARTIFACTS_PATH>/spool/ with a meta.json and append-only segment files of length prefixed
+pickled records, and a `closed` marker once the run is done. The sync process batches the records of a step into one
+run.log and remembers how far it got in synced.json, so it can be interrupted and resumed:
+
+    python -m mila_tools.spool sync [spool folder] [--watch SECONDS]
+"""
+import argparse
+import atexit
+import collections
+import json
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+
+SEGMENT_BYTES = 64 * 2 ** 20
+FLUSH_INTERVAL = 1.  # seconds, bounds what a crash can lose and how stale a concurrent sync can be
+_HEADER = struct.Struct(">I")
+CLOSED = "closed"  # marker file, no more records will be appended
+
+SpooledImage = collections.namedtuple("SpooledImage", "data")  # a file path or an array
+
+
+class _SpoolConfig:
+    def __init__(self, spool):
+        self._spool = spool
+        self._items = {}  # mirrors wandb.config._items, nothing is set by a sweep while offline
+
+    def update(self, params):
+        self._items.update(params)
+        self._spool.append(("config", params))
+
+
+class _SpoolRun:
+    """ Stands in for a wandb Run: log, save and config.update append records instead of talking to the service. """
+
+    def __init__(self, spool_path, project_name, name, entity=None):
+        self.name = name
+        self.id = uuid.uuid4().hex[:8]
+        self.path = os.path.join(spool_path, f"{self.id}")
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, "meta.json"), "w") as fout:
+            json.dump({"id": self.id, "name": name, "project": project_name, "entity": entity}, fout)
+
+        self.config = _SpoolConfig(self)
+        self._lock = threading.Lock()  # the scalar pipeline and the checkpoint workers log from their own threads
+        self._segment = -1
+        self._fout = None
+        self._next_segment()
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def _next_segment(self):
+        if self._fout:
+            self._fout.close()
+        self._segment += 1
+        self._fout = open(os.path.join(self.path, f"segment-{self._segment:05d}.bin"), "ab")
+
+    def append(self, record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._fout.write(_HEADER.pack(len(payload)) + payload)
+            if self._fout.tell() > SEGMENT_BYTES:
+                self._next_segment()
+            elif time.monotonic() - self._last_flush > FLUSH_INTERVAL:
+                self._fout.flush()
+                self._last_flush = time.monotonic()
+
+    def log(self, row, step=None, commit=None):
+        self.append(("log", step, row))
+
+    def save(self, path, base_path=None, policy="live"):
+        self.append(("save", os.path.abspath(path), base_path and os.path.abspath(base_path), policy))
+
+    def watch(self, *args, **kwargs):
+        raise NotImplementedError("watch needs a live wandb run")
+
+    def flush(self):
+        with self._lock:
+            self._fout.flush()
+
+    def close(self):
+        with self._lock:
+            self._fout.close()
+            open(os.path.join(self.path, CLOSED), "w").close()
+        atexit.unregister(self.close)
+
+
+def _read_records(segment_path, offset):
+    """ Yields (record, offset after it), a record cut short by a crash ends the segment. """
+    with open(segment_path, "rb") as fin:
+        fin.seek(offset)
+        while True:
+            header = fin.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            payload = fin.read(_HEADER.unpack(header)[0])
+            if len(payload) < _HEADER.unpack(header)[0]:
+                return
+            offset += _HEADER.size + len(payload)
+            yield pickle.loads(payload), offset
+
+
+def _has_new_records(run_path, segments, progress):
+    for segment in segments:
+        segment_idx = int(segment[8:13])
+        if segment_idx > progress["segment"]:
+            return True
+        if segment_idx == progress["segment"] and os.path.getsize(os.path.join(run_path, segment)) > progress["offset"]:
+            return True
+    return False
+
+
+def _to_wandb(value, wandb):
+    from .metrics import HistogramStats
+
+    if isinstance(value, HistogramStats):
+        return wandb.Histogram(np_histogram=(value.counts, value.edges))
+    if isinstance(value, SpooledImage):
+        return wandb.Image(value.data)
+    return value
+
+
+def sync_run(run_path, wandb=None):
+    """ Replays the records of a spooled run not synced yet, returns how many it sent. Until the run is closed the
+        last step is held back, the run may still log to it and a resumed wandb run drops logs to past steps.
+    """
+    if wandb is None:
+        import wandb
+
+    with open(os.path.join(run_path, "meta.json")) as fin:
+        meta = json.load(fin)
+    progress_path = os.path.join(run_path, "synced.json")
+    progress = {"segment": 0, "offset": 0}
+    if os.path.exists(progress_path):
+        with open(progress_path) as fin:
+            progress = json.load(fin)
+
+    closed = os.path.exists(os.path.join(run_path, CLOSED))  # before reading, all it covers is on disk
+    segments = sorted(f for f in os.listdir(run_path) if f.startswith("segment-"))
+    # progress is where to resume, its "end" how far the last pass read, past the step it held back
+    end = progress.get("end", progress)
+    held_back = (end["segment"], end["offset"]) != (progress["segment"], progress["offset"])
+    if not _has_new_records(run_path, segments, end) and not (closed and held_back):
+        return 0
+
+    run = wandb.init(project=meta["project"], name=meta["name"], entity=meta["entity"], id=meta["id"], resume="allow",
+                     reinit=True)
+    sent = 0
+    row, row_step, row_records, row_start = {}, None, 0, None
+
+    def send_row():
+        nonlocal sent
+        if row:
+            run.log({k: _to_wandb(v, wandb) for k, v in row.items()}, step=row_step, commit=False)
+            sent += row_records
+
+    for segment in segments:
+        segment_idx = int(segment[8:13])
+        if segment_idx < progress["segment"]:
+            continue
+        offset = progress["offset"] if segment_idx == progress["segment"] else 0
+        for record, next_offset in _read_records(os.path.join(run_path, segment), offset):
+            kind = record[0]
+            if kind == "log":
+                _, step, values = record
+                if step != row_step:
+                    send_row()
+                    row, row_step, row_records = {}, step, 0
+                    row_start = {"segment": segment_idx, "offset": offset}
+                row.update(values)
+                row_records += 1
+            else:
+                send_row()
+                row, row_step, row_records, row_start = {}, None, 0, None
+                if kind == "config":
+                    run.config.update(record[1], allow_val_change=True)
+                elif kind == "save":
+                    run.save(*record[1:3], policy=record[3] if len(record) > 3 else "live")
+                sent += 1
+            offset = next_offset
+        # the row being built is not synced yet, a resumed sync reads it again from its first record
+        end = {"segment": segment_idx, "offset": offset}
+        with open(progress_path, "w") as fout:
+            json.dump({**(row_start or end), "end": end}, fout)
+    if closed:
+        send_row()
+        with open(progress_path, "w") as fout:
+            json.dump({**end, "end": end}, fout)
+    run.finish()
+    return sent
+
+
+def sync(spool_path, wandb=None):
+    """ Syncs every run in the spool folder, returns {run id: records sent}. """
+    if not os.path.isdir(spool_path):
+        return {}
+    return {run_id: sync_run(os.path.join(spool_path, run_id), wandb) for run_id in sorted(os.listdir(spool_path))
+            if os.path.exists(os.path.join(spool_path, run_id, "meta.json"))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay spooled mila_tools runs to wandb")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sync_parser = subparsers.add_parser("sync")
+    sync_parser.add_argument("spool_path", nargs="?", default="runs/spool/")
+    sync_parser.add_argument("--watch", type=float, default=0., help="keep syncing every WATCH seconds")
+    args = parser.parse_args()
+
+    while True:
+        start = time.perf_counter()
+        sent = sync(args.spool_path)
+        total = sum(sent.values())
+        print(f"synced {total} records from {len(sent)} runs, {total / (time.perf_counter() - start):.0f} records/s")
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import atexit
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+# The deploys share an OpenSSH master connection that outlives them, only the first one pays for the handshake and the
+# authentication. BUDDY_SSH_CONTROL_PERSIST is how long the master stays up once idle, "no" falls back to paramiko.
+CONTROL_PERSIST = os.environ.get("BUDDY_SSH_CONTROL_PERSIST", "30m")
+CONTROL_PATH = "~/.ssh/mila_tools-%C"
+_STARTED = "@@mila_tools-started"
+
+
+class _NotStarted(ConnectionError):
+    """ ssh failed before the remote command ran, it is safe to run it again. """
+
+
+class _OpenSSHSession:
+    """ The subset of fabric.Connection the schedulers and scripts_cache use, through the system ssh and the shared
+        master connection. Remote commands echo a marker first, so a failure of ssh itself (exit status 255) is known
+        to have happened before or after the command started.
+    """
+    transient_errors = (_NotStarted,)
+
+    def __init__(self, host, control_persist=CONTROL_PERSIST):
+        self.host = host
+        os.makedirs(os.path.expanduser("~/.ssh"), mode=0o700, exist_ok=True)
+        # the keepalives let the master notice a half-open connection (laptop sleep, NAT timeout) instead of hanging
+        self._options = ["-o", "ControlMaster=auto", "-o", f"ControlPath={CONTROL_PATH}",
+                         "-o", f"ControlPersist={control_persist}", "-o", "ServerAliveInterval=15",
+                         "-o", "ServerAliveCountMax=2", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes"]
+
+    def _call(self, command, stdin=None):
+        retr = subprocess.run(["ssh", *self._options, self.host, f"echo {_STARTED}; {command}"], input=stdin,
+                              capture_output=True)
+        _, started, stdout = retr.stdout.partition(f"{_STARTED}\n".encode())
+        if not started:
+            if retr.returncode == 255:
+                raise _NotStarted(f"ssh {self.host}: {retr.stderr.decode(errors='replace').strip()}")
+            stdout = retr.stdout
+        retr = subprocess.CompletedProcess(retr.args, retr.returncode, stdout.decode(errors="replace"),
+                                           retr.stderr.decode(errors="replace"))
+        if retr.returncode != 0:
+            raise subprocess.CalledProcessError(retr.returncode, command, retr.stdout, retr.stderr)
+        return retr
+
+    def run(self, command, hide=True):
+        retr = self._call(command)
+        if not hide:
+            print(retr.stdout, end="")
+            print(retr.stderr, end="")
+        return retr
+
+    def put(self, local, remote):
+        """ remote paths are relative to the home folder, as with sftp """
+        if hasattr(local, "read"):
+            data = local.read()
+        else:
+            with open(local, "rb") as fin:
+                data = fin.read()
+        self._call(f"cat > {shlex.quote(remote)}", stdin=data)
+
+    def is_alive(self):
+        return subprocess.run(["ssh", *self._options, "-O", "check", self.host], capture_output=True).returncode == 0
+
+    def close(self):
+        """ The master is left running for the next deploys, ControlPersist ends it. """
+
+
+def _connect_help(hostname):
+    return ("SSH connection failed!,"
+            f"Make sure you can successfully run `ssh {hostname}` with no parameters, any parameters should be set in the ssh_config file"
+            "If you need a password to authenticate set the Environment variable BUDDY_PASSWORD.")
+
+
+def _connect(hostname):
+    """ An _OpenSSHSession, or a fabric.Connection when a password is needed (OpenSSH will not take it from the
+        environment) or there is no ssh client. TODO add time-out for unknown host
+    """
+    if "BUDDY_PASSWORD" not in os.environ and CONTROL_PERSIST != "no" and shutil.which("ssh"):
+        ssh_session = _OpenSSHSession(hostname)
+        try:
+            ssh_session.run("true")  # starts the master, or reuses the one of a previous deploy
+        except (_NotStarted, subprocess.CalledProcessError) as e:
+            raise ConnectionError(_connect_help(hostname)) from e
+        return ssh_session
+
+    import fabric
+    from paramiko.ssh_exception import SSHException
+
+    kwargs_connection = {
+        "host": hostname
+    }
+    try:
+        kwargs_connection["connect_kwargs"] = {"password": os.environ["BUDDY_PASSWORD"]}
+    except KeyError:
+        pass
+
+    try:
+        ssh_session = fabric.Connection(**kwargs_connection, connect_timeout=10)
+        ssh_session.open()
+    except SSHException as e:
+        raise SSHException(_connect_help(hostname))
+
+    return ssh_session
+
+
+def _is_alive(ssh_session, timeout=10.):
+    if isinstance(ssh_session, _OpenSSHSession):
+        return ssh_session.is_alive()
+    transport = ssh_session.transport
+    if transport is None or not transport.is_active():
+        return False
+
+    # a real round trip: a half-open connection takes writes without complaint and never answers
+    answered = threading.Event()
+
+    def keepalive():
+        try:
+            transport.global_request("keepalive@openssh.com", wait=True)  # a refusal is an answer too
+        except Exception:
+            return
+        if transport.is_active():
+            answered.set()
+
+    threading.Thread(target=keepalive, name="mila_tools-ssh-keepalive", daemon=True).start()
+    return answered.wait(timeout)
+
+
+class _ConnectionCache:
+    """ One live session per hostname, health checked and reopened after `idle_timeout` seconds unused.
+        A connection that dies between commands is reopened by fabric itself on the next run/put.
+    """
+
+    def __init__(self, idle_timeout=300.):
+        self.idle_timeout = idle_timeout
+        self._connections = {}  # hostname -> [connection, last_used]
+        self._lock = threading.Lock()
+        atexit.register(self.close_all)
+
+    def get(self, hostname):
+        with self._lock:
+            entry = self._connections.pop(hostname, None)
+            if entry is not None:
+                ssh_session, last_used = entry
+                if time.monotonic() - last_used < self.idle_timeout and _is_alive(ssh_session):
+                    self._connections[hostname] = [ssh_session, time.monotonic()]
+                    return ssh_session
+                ssh_session.close()
+
+            ssh_session = _connect(hostname)
+            self._connections[hostname] = [ssh_session, time.monotonic()]
+            return ssh_session
+
+    def close_all(self):
+        with self._lock:
+            for ssh_session, _ in self._connections.values():
+                ssh_session.close()
+            self._connections.clear()
+
+
+_connections = _ConnectionCache(idle_timeout=float(os.environ.get("BUDDY_SSH_IDLE_TIMEOUT", 300)))
@@ -0,0 +1,112 @@
+""" Timing spans of a deploy, from the client stages to the first datapoint logged by the job.
+
+Spans are appended as they end, one Chrome trace event per line, to the file in $MILA_TOOLS_TRACE; deploy() defaults it
+to <ARTIFACTS_PATH>/traces/ and the job scripts to ~/.cache/mila_tools/traces/ on the cluster. Timestamps are wall
+clock microseconds so the files of the client and of the jobs line up:
+
+    python -m mila_tools.trace summary TRACE...            # per span: count, total and mean seconds
+    python -m mila_tools.trace chrome OUT.json TRACE...    # merged, for chrome://tracing or ui.perfetto.dev
+"""
+import argparse
+import collections
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+TRACE_ENV = "MILA_TOOLS_TRACE"
+JOB_START_ENV = "MILA_TOOLS_JOB_START"  # microseconds, exported by job_lib.sh when the job starts
+
+
+def _process_start():
+    """ Wall clock start of this process, from /proc on Linux, otherwise when this module got imported. """
+    try:
+        with open("/proc/self/stat") as fin:
+            start_ticks = int(fin.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as fin:
+            uptime = float(fin.read().split()[0])
+        return time.time() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError):
+        return time.time()
+
+
+PROCESS_START = _process_start()
+
+
+class _Tracer:
+    def __init__(self, path=None):
+        self.path = path
+        self.events = []
+        self._lock = threading.Lock()
+        self._host = socket.gethostname()
+
+    def record(self, name, start, end, category="deploy", **args):
+        """ start and end are time.time() seconds. """
+        event = {"name": name, "cat": category, "ph": "X", "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+                 "pid": os.getpid(), "tid": threading.get_ident(), "args": {"host": self._host, **args}}
+        with self._lock:
+            self.events.append(event)
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a") as fout:
+                    fout.write(json.dumps(event) + "\n")
+        return event
+
+    @contextlib.contextmanager
+    def span(self, name, category="deploy", **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time(), category, **args)
+
+
+tracer = _Tracer(os.environ.get(TRACE_ENV))
+
+
+def load(path):
+    """ Events of a trace file, either one event per line or a Chrome trace. """
+    with open(path) as fin:
+        content = fin.read()
+    if content.lstrip().startswith("{\"traceEvents\""):
+        return json.loads(content)["traceEvents"]
+    return [json.loads(row) for row in content.splitlines() if row.strip()]
+
+
+def to_chrome(events, path):
+    with open(path, "w") as fout:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fout)
+
+
+def summary(events):
+    """ {name: (count, total seconds, mean seconds)}, in order of first appearance. """
+    durations = collections.defaultdict(list)
+    for event in sorted(events, key=lambda e: e["ts"]):
+        durations[event["name"]].append(event["dur"] / 1e6)
+    return {name: (len(d), sum(d), sum(d) / len(d)) for name, d in durations.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect mila_tools deploy traces")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary")
+    summary_parser.add_argument("traces", nargs="+")
+    chrome_parser = subparsers.add_parser("chrome")
+    chrome_parser.add_argument("output")
+    chrome_parser.add_argument("traces", nargs="+")
+    args = parser.parse_args()
+
+    events = [event for path in args.traces for event in load(path)]
+    if args.command == "chrome":
+        to_chrome(events, args.output)
+        print(f"wrote {len(events)} events to {args.output}")
+        return
+    print(f"{'span':24s} {'count':>5s} {'total s':>9s} {'mean s':>9s}")
+    for name, (count, total, mean) in summary(events).items():
+        print(f"{name:24s} {count:5d} {total:9.3f} {mean:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#! /bin/bash
+# Helpers sourced by the job scripts, the folder is passed in $MILA_TOOLS_SCRIPTS or found next to the caller.
+function log() {
+  echo -e "\e[32m"[DEPLOY LOG] $1"\e[0m"
+}
+
+# Timing spans of the job, one Chrome trace event per line, see mila_tools/trace.py. The job start is exported so the
+# python side can measure the time to the first datapoint.
+export MILA_TOOLS_JOB_START=${MILA_TOOLS_JOB_START:-$(date +%s%6N)}
+export MILA_TOOLS_TRACE=${MILA_TOOLS_TRACE:-$HOME/.cache/mila_tools/traces/${SLURM_JOB_ID:-${MILA_TOOLS_JOB_ID:-$$}}.jsonl}
+
+# Runs "$@" in the current shell and appends a span named $1 to $MILA_TOOLS_TRACE, returns the status of the command.
+function timed() {
+  local name=$1 start status
+  shift
+  start=$(date +%s%6N)
+  "$@"
+  status=$?
+  mkdir -p "$(dirname "$MILA_TOOLS_TRACE")"
+  echo "{\"name\": \"$name\", \"cat\": \"job\", \"ph\": \"X\", \"ts\": $start, \"dur\": $(($(date +%s%6N) - start)), \"pid\": $$, \"tid\": $$, \"args\": {\"host\": \"$(hostname)\", \"status\": $status}}" >>"$MILA_TOOLS_TRACE"
+  return $status
+}
+
+VENV_CACHE=$HOME/.cache/mila_tools/venvs
+
+# The name of the venv for $1 (hash of the requirements), combined with the python the job runs, the one the venv is
+# built on: the python version of the client does not matter.
+function venv_key() {
+  echo "$1-$(python -c 'import sys; print(sys.implementation.cache_tag, sys.base_prefix)' | sha1sum | cut -c1-8)"
+}
+
+# Activates the venv for requirements.txt of the current folder, see venv_key.
+# The venv is built once on the shared filesystem, concurrent jobs with the same key wait on the lock.
+function activate_cached_venv() {
+  local key venv
+  key=$(venv_key "$1")
+  venv=$VENV_CACHE/$key
+  mkdir -p "$VENV_CACHE"
+  (
+    flock 9
+    if [ ! -f "$venv/.complete" ]; then
+      log "Building venv @ $venv..."
+      rm -rf "$venv"
+      python -m virtualenv "$venv" || exit 1
+      # shellcheck disable=SC1090
+      source "$venv/bin/activate"
+      python -m pip install --upgrade pip || exit 1
+      log "Downloading modules"
+      sh $HOME/install_jax.sh || exit 1 # TODO: move this to mila_tools
+      python -m pip install -r "requirements.txt" --exists-action w || exit 1
+      touch "$venv/.complete"
+    fi
+  ) 9>"$VENV_CACHE/$key.lock" || return 1
+  log "Using cached venv @ $venv"
+  # shellcheck disable=SC1090
+  source "$venv/bin/activate"
+}
+
+GIT_MIRRORS=$HOME/.cache/mila_tools/git
+
+# Checks out the snapshot tag $2 of the repo at $1 into $3, fetching only that commit. The checkout has $1 as origin,
+# deploy() reads the project name from it.
+# Objects already in a persistent bare mirror of the repo are borrowed instead of downloaded, the mirror is refreshed
+# at most every 10 minutes and concurrent jobs wait on its lock.
+function fetch_snapshot() {
+  local mirror
+  mirror=$GIT_MIRRORS/$(echo -n "$1" | sha1sum | cut -c1-16).git
+  mkdir -p "$GIT_MIRRORS"
+  (
+    flock 9
+    if [ ! -d "$mirror" ]; then
+      log "mirroring $1 to $mirror"
+      git clone -q --bare "$1" "$mirror" && touch "$mirror"
+    elif [ -z "$(find "$mirror" -maxdepth 0 -mmin -10)" ]; then
+      log "refreshing $mirror"
+      git -C "$mirror" fetch -q "$1" "+refs/heads/*:refs/heads/*" && touch "$mirror"
+    fi
+  ) 9>"$mirror.lock" || log "could not refresh $mirror, fetching without it"
+
+  mkdir -p "$3"
+  git init -q "$3"
+  git -C "$3" remote add origin "$1"
+  if [ -d "$mirror/objects" ]; then
+    echo "$mirror/objects" >"$3/.git/objects/info/alternates"
+  fi
+  git -C "$3" fetch -q --depth 1 "$1" "refs/tags/$2" || return 1
+  git -C "$3" checkout -q FETCH_HEAD
+}
@@ -9,36 +9,61 @@
 #SBATCH --partition=long
 #SBATCH --get-user-env=L
 
-# Module system
-function log() {
-  echo -e "\e[32m"[DEPLOY LOG] $1"\e[0m"
-}
+# sbatch runs a copy of this script, job_lib.sh is found through $MILA_TOOLS_SCRIPTS
+# shellcheck disable=SC1090
+source "$MILA_TOOLS_SCRIPTS/job_lib.sh"
 
 source /etc/profile
-log "Refreshing modules..."
-module purge
-module load python/3.8
-module load cuda/10.1/cudnn/7.6
+# hosts without environment modules run with their own python, see schedulers.ProcessScheduler
+if command -v module > /dev/null; then
+  log "Refreshing modules..."
+  module purge
+  module load python/3.8
+  module load cuda/10.1/cudnn/7.6
+fi
 
-FOLDER=$SLURM_TMPDIR/src/
+FOLDER=${SLURM_TMPDIR:-$(mktemp -d)}/src/
 
-log "downloading source code from $1 to $FOLDER"
-git clone $1 $FOLDER/
+log "downloading $3 from $1 to $FOLDER"
+timed clone fetch_snapshot "$1" "$3" "$FOLDER" || exit 1
 cd $FOLDER || exit
-git checkout $3
 log "pwd is now $(pwd)"
 
-# Set up virtualenv in $SLURM_TMPDIR. Will get blown up at job end.
-log "Setting up venv @ $SLURM_TMPDIR/venv..."
-python -m virtualenv "$SLURM_TMPDIR/venv"
-# shellcheck disable=SC1090
-source "$SLURM_TMPDIR/venv/bin/activate"
-python -m pip install --upgrade pip
-
-log "Downloading modules"
-sh $HOME/install_jax.sh # TODO: move this to mila_tools
-python -m pip install -r "requirements.txt" --exists-action w
+timed venv activate_cached_venv "$4" || exit 1
 
 export XLA_FLAGS=--xla_gpu_cuda_data_dir=/cvmfs/ai.mila.quebec/apps/x86_64/common/cuda/10.1/
 # TODO: the client should send the mila_tools version to avoid issues
-wandb agent "$2"
+AGENTS=${5:-1}
+if [ "$AGENTS" -le 1 ]; then
+  wandb agent "$2"
+  exit
+fi
+
+# The agents share the setup above and split the allocation: a slice of the cpus and of the gpu memory each
+mapfile -t CPUS < <(python -c 'import os; print(*sorted(os.sched_getaffinity(0)), sep="\n")')
+CPUS_PER_AGENT=$((${#CPUS[@]} / AGENTS))
+export XLA_PYTHON_CLIENT_MEM_FRACTION=$(python -c "print(round(0.9 / $AGENTS, 3))")
+
+PIDS=()
+for ((i = 0; i < AGENTS; i++)); do
+  if [ "$CPUS_PER_AGENT" -ge 1 ]; then
+    AGENT_CPUS=$(IFS=,; echo "${CPUS[*]:$((i * CPUS_PER_AGENT)):$CPUS_PER_AGENT}")
+  else
+    AGENT_CPUS=$(IFS=,; echo "${CPUS[*]}")
+  fi
+  log "starting agent $i on cpus $AGENT_CPUS"
+  OMP_NUM_THREADS=$((CPUS_PER_AGENT > 0 ? CPUS_PER_AGENT : 1)) taskset -c "$AGENT_CPUS" wandb agent "$2" &
+  PIDS+=($!)
+done
+
+STATUS=0
+for i in "${!PIDS[@]}"; do
+  if wait "${PIDS[$i]}"; then
+    log "agent $i exited with 0"
+  else
+    CODE=$?
+    log "agent $i exited with $CODE"
+    STATUS=$CODE
+  fi
+done
+exit $STATUS